@@ -3,49 +3,272 @@ import sys
 import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+import argparse
+import itertools
+import tempfile
+import threading
 import pandas as pd
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from rag.query_router import answer_math_question
+from rag.query_router import answer_math_question_with_trace, answer_cache, web_search, memoize_retrievals, STAGES
+from rag.cache import DiskCache
+from rag.clients import get_input_validator, get_output_validator
+from rag.cassette import record_or_replay, use_cassette
 from data.load_gsm8k_data import load_jeebench_dataset
 
-def benchmark_math_agent(limit: int = 10):
-    # ✅ Always filter math-only questions
-    df = load_jeebench_dataset()
-    df = df.head(limit)  # Limit the number of questions for benchmarking
-
-    total = len(df)
-    correct = 0
-    results = []
-
-    for idx, row in df.iterrows():
-        question = row["question"]
-        expected = row["gold"]
-        start = time.time()
-
-        try:
-            response = answer_math_question(question)
-            is_correct = expected.lower() in response.lower()
-            if is_correct:
-                correct += 1
-
-            results.append({
-                "Question": question,
-                "Expected": expected,
-                "Predicted": response,
-                "Correct": is_correct,
-                "TimeTakenSec": round(time.time() - start, 2)
-            })
-
-        except Exception as e:
-            results.append({
-                "Question": question,
-                "Expected": expected,
-                "Predicted": f"Error: {e}",
-                "Correct": False,
-                "TimeTakenSec": None
-            })
-
-    df_result = pd.DataFrame(results)
+STAGE_COLUMNS = [f"{stage}Sec" for stage in STAGES]
+RESULT_COLUMNS = ["Question", "Expected", "Predicted", "Correct", "TimeTakenSec"] + STAGE_COLUMNS + ["SpeculationSavedSec"]
+
+
+class RateLimiter:
+    """Spaces out question starts so all workers together stay under `rate_per_minute`."""
+
+    def __init__(self, rate_per_minute: float | None = None):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute else 0.0
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def _benchmark_one(question: str, expected: str, rate_limiter: RateLimiter, config: dict | None = None):
+    rate_limiter.wait()
+    start = time.time()
+
+    try:
+        response, trace = answer_math_question_with_trace(question, config)
+        is_correct = expected.lower() in response.lower()
+        row = {
+            "Question": question,
+            "Expected": expected,
+            "Predicted": response,
+            "Correct": is_correct,
+            "TimeTakenSec": round(time.time() - start, 2),
+            "LLMCalls": trace["llm_calls"],  # used by the sweep; not part of RESULT_COLUMNS
+        }
+        # Stages that did not run for this question stay empty (NaN) in the CSV
+        for stage, seconds in trace["stages"].items():
+            row[f"{stage}Sec"] = round(seconds, 3)
+        if trace["speculation"]["used"]:
+            row["SpeculationSavedSec"] = round(trace["speculation"]["saved_sec"], 3)
+        return row
+
+    except Exception as e:
+        return {
+            "Question": question,
+            "Expected": expected,
+            "Predicted": f"Error: {e}",
+            "Correct": False,
+            "TimeTakenSec": None
+        }
+
+
+def _load_questions(limit: int):
+    def load():
+        # ✅ Always filter math-only questions
+        df = load_jeebench_dataset()
+        df = df.head(limit)  # Limit the number of questions for benchmarking
+        return [[question, gold] for question, gold in zip(df["question"], df["gold"])]
+
+    # The question set is part of the cassette so replayed runs need no network at all
+    return record_or_replay("dataset", f"jeebench-math-{limit}", load)
+
+
+def _load_finished_rows(output_path: str):
+    # Rows from a previous (possibly interrupted) run; errored questions are retried
+    if not output_path or not os.path.exists(output_path):
+        return {}
+    previous = pd.read_csv(output_path)
+    finished = {}
+    for row in previous.to_dict("records"):
+        if str(row["Predicted"]).startswith("Error:"):
+            continue
+        row["Correct"] = str(row["Correct"]).strip().lower() == "true"
+        finished[row["Question"]] = row
+    return finished
+
+
+def benchmark_math_agent(limit: int = 10, workers: int = 1, rate_per_minute: float | None = None,
+                         output_path: str | None = None, resume: bool = False):
+    questions = _load_questions(limit)
+    total = len(questions)
+    get_output_validator().reset_cache_stats()
+    results = [None] * total
+
+    finished = _load_finished_rows(output_path) if resume else {}
+    pending = []
+    for pos, (question, expected) in enumerate(questions):
+        if question in finished:
+            results[pos] = finished[question]
+        else:
+            pending.append((pos, question, expected))
+    if finished:
+        print(f"⏩ Resuming: {total - len(pending)}/{total} questions already answered in {output_path}")
+
+    # Results are appended to the CSV as each question finishes
+    write_lock = threading.Lock()
+    if output_path:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        # Start from the kept rows only, so the header always matches RESULT_COLUMNS
+        pd.DataFrame(list(finished.values()), columns=RESULT_COLUMNS).to_csv(output_path, index=False)
+
+    rate_limiter = RateLimiter(rate_per_minute)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(_benchmark_one, question, expected, rate_limiter): pos
+            for pos, question, expected in pending
+        }
+        for future in as_completed(futures):
+            row = future.result()
+            results[futures[future]] = row
+            if output_path:
+                with write_lock:
+                    pd.DataFrame([row], columns=RESULT_COLUMNS).to_csv(output_path, mode="a", header=False, index=False)
+
+    df_result = pd.DataFrame(results, columns=RESULT_COLUMNS)
+    if output_path:
+        # Rewrite in question order
+        df_result.to_csv(output_path, index=False)
+
+    correct = int(df_result["Correct"].sum())
     accuracy = correct / total * 100
     return df_result, accuracy
+
+
+def stage_latency_summary(df_result: pd.DataFrame) -> pd.DataFrame:
+    """p50/p95/p99 latency per pipeline stage, over the questions where that stage ran."""
+    rows = []
+    for stage, column in zip(STAGES + ["Total"], STAGE_COLUMNS + ["TimeTakenSec"]):
+        if column not in df_result:
+            continue
+        values = pd.to_numeric(df_result[column], errors="coerce").dropna()
+        if values.empty:
+            continue
+        rows.append({
+            "Stage": stage,
+            "Runs": len(values),
+            "MeanSec": round(values.mean(), 3),
+            "P50Sec": round(values.quantile(0.50), 3),
+            "P95Sec": round(values.quantile(0.95), 3),
+            "P99Sec": round(values.quantile(0.99), 3),
+        })
+    return pd.DataFrame(rows, columns=["Stage", "Runs", "MeanSec", "P50Sec", "P95Sec", "P99Sec"])
+
+
+# Router configurations compared by sweep_router_configs (every combination is run)
+SWEEP_GRID = {
+    "similarity_top_k": [1, 3],
+    "similarity_cutoff": [0.0, 0.5, 0.8],
+    "input_fast_path": [True, False],
+    "output_guardrail": [True, False],
+}
+
+
+def _pareto_front(df: pd.DataFrame, cost_column: str) -> pd.Series:
+    # A configuration is on the frontier if no other one is at least as accurate and cheaper (or equal cost, more accurate)
+    return df.apply(lambda row: not (
+        (df["Accuracy"] >= row["Accuracy"]) & (df[cost_column] <= row[cost_column])
+        & ((df["Accuracy"] > row["Accuracy"]) | (df[cost_column] < row[cost_column]))
+    ).any(), axis=1)
+
+
+def sweep_router_configs(limit: int = 10, grid: dict = SWEEP_GRID, workers: int = 4, rate_per_minute: float | None = None):
+    """Run every router configuration in `grid` over the same questions and return a table of
+    accuracy vs latency and accuracy vs LLM calls, with the Pareto frontier for each flagged."""
+    questions = _load_questions(limit)
+    # Verified answers would also skip the pipeline for any question rated 👍; the grid may still sweep them
+    configs = [{"verified_answers": False, **dict(zip(grid, values))} for values in itertools.product(*grid.values())]
+    rate_limiter = RateLimiter(rate_per_minute)
+
+    # The answer and verdict caches would serve every configuration after the first (hiding its
+    # LLM calls and latency), and each configuration starts from an empty web-search cache of its own;
+    # KB retrievals are shared instead
+    output_validator = get_output_validator()
+    cache_was_enabled, answer_cache.enabled = answer_cache.enabled, False
+    verdicts_were_cached, output_validator.cache_enabled = output_validator.cache_enabled, False
+    shared_web_cache = web_search.cache
+    rows = []
+    try:
+        with tempfile.TemporaryDirectory() as web_cache_dir, memoize_retrievals(), \
+                ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            # Largest top_k first so smaller ones are served from the memoized retrievals
+            for n, config in enumerate(sorted(configs, key=lambda c: -c.get("similarity_top_k", 1))):
+                print(f"🧪 Sweep config: {config}")
+                web_search.cache = DiskCache(os.path.join(web_cache_dir, f"web_search_{n}.sqlite"),
+                                             max_entries=shared_web_cache.max_entries,
+                                             ttl_seconds=shared_web_cache.ttl_seconds)
+                results = list(pool.map(lambda qa: _benchmark_one(qa[0], qa[1], rate_limiter, config), questions))
+                df_config = pd.DataFrame(results)
+                latency = pd.to_numeric(df_config["TimeTakenSec"], errors="coerce")
+                rows.append({
+                    **config,
+                    "Accuracy": round(df_config["Correct"].sum() / len(questions) * 100, 2),
+                    "MeanSec": round(latency.mean(), 3),
+                    "P95Sec": round(latency.quantile(0.95), 3),
+                    "MeanLLMCalls": round(pd.to_numeric(df_config.get("LLMCalls", pd.Series(dtype=float)), errors="coerce").mean(), 2),
+                    "Errors": int(df_config["Predicted"].astype(str).str.startswith("Error:").sum()),
+                })
+    finally:
+        answer_cache.enabled = cache_was_enabled
+        output_validator.cache_enabled = verdicts_were_cached
+        web_search.cache = shared_web_cache
+
+    df_sweep = pd.DataFrame(rows)
+    df_sweep["LatencyFrontier"] = _pareto_front(df_sweep, "MeanSec")
+    df_sweep["LLMCallFrontier"] = _pareto_front(df_sweep, "MeanLLMCalls")
+    return df_sweep.sort_values(["Accuracy", "MeanSec"], ascending=[False, True]).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the math agent on JEEBench math questions.")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate-per-minute", type=float, default=None, help="Max question starts per minute across all workers")
+    parser.add_argument("--output", default=None, help="Results CSV (default: benchmark/results_math_<limit>.csv)")
+    parser.add_argument("--resume", action="store_true", help="Skip questions already answered in the output CSV")
+    parser.add_argument("--record", metavar="CASSETTE", help="Record every external response to this cassette file")
+    parser.add_argument("--replay", metavar="CASSETTE", help="Serve every external response from this cassette file (offline)")
+    parser.add_argument("--replay-latency", default=None, help="Synthetic latency in replay: 'recorded' or fixed seconds")
+    parser.add_argument("--no-answer-cache", action="store_true", help="Bypass the answer cache so every question runs the full pipeline")
+    parser.add_argument("--sweep", action="store_true", help="Run every SWEEP_GRID router configuration and print the accuracy frontier")
+    args = parser.parse_args()
+
+    if args.record:
+        use_cassette(args.record, mode="record")
+    elif args.replay:
+        use_cassette(args.replay, mode="replay", latency=args.replay_latency)
+    if args.no_answer_cache:
+        answer_cache.enabled = False
+
+    if args.sweep:
+        sweep_path = args.output or f"benchmark/sweep_math_{args.limit}.csv"
+        df_sweep = sweep_router_configs(args.limit, workers=args.workers, rate_per_minute=args.rate_per_minute)
+        df_sweep.to_csv(sweep_path, index=False)
+        print(df_sweep.to_string(index=False))
+        print("\n🏁 Accuracy vs latency frontier:")
+        print(df_sweep[df_sweep["LatencyFrontier"]].to_string(index=False))
+        print("\n🏁 Accuracy vs LLM calls frontier:")
+        print(df_sweep[df_sweep["LLMCallFrontier"]].to_string(index=False))
+        print(f"→ {sweep_path}")
+        sys.exit(0)
+
+    output_path = args.output or f"benchmark/results_math_{args.limit}.csv"
+    started = datetime.now()
+    df_result, accuracy = benchmark_math_agent(args.limit, args.workers, args.rate_per_minute, output_path, args.resume)
+    elapsed = (datetime.now() - started).total_seconds()
+    print(f"✅ Accuracy: {accuracy:.2f}% on {len(df_result)} questions in {elapsed:.1f}s "
+          f"({len(df_result) / elapsed:.2f} questions/s) → {output_path}")
+    print(stage_latency_summary(df_result).to_string(index=False))
+    print("⚡ Input guard fast path:", get_input_validator().fast_path_report())
+    print("🗂️ Output verdict cache:", get_output_validator().verdict_cache_report())
+    if "SpeculationSavedSec" in df_result:
+        print(f"🏎️ Speculative retrieval saved {pd.to_numeric(df_result['SpeculationSavedSec'], errors='coerce').sum():.2f}s in total")
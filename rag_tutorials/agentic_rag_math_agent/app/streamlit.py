@@ -1,16 +1,18 @@
 import streamlit as st
 import sys
 import os
-import json
 import pandas as pd
 
 # Add root to import path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
-from app.benchmark import benchmark_math_agent  # Add this import
+from app.benchmark import benchmark_math_agent, stage_latency_summary, STAGE_COLUMNS  # Add this import
 from data.load_gsm8k_data import load_jeebench_dataset
-from rag.query_router import answer_math_question
+from rag.query_router import answer_math_question, warm_kb_index, feedback_store, answer_cache
 
 st.set_page_config(page_title="Math Agent 🧮", layout="wide")
+
+# Load the shared KB index once at startup instead of on the first question
+warm_kb_index()
 st.title("🧠 Math Tutor Agent Dashboard")
 
 tab1, tab2, tab3 = st.tabs(["📘 Ask a Question", "📁 View Feedback", "📊 Benchmark Results"])
@@ -55,26 +57,16 @@ with tab1:
                     st.session_state["feedback_given"] = True
 
             if st.session_state["feedback_given"]:
-                log_entry = {
-                    "question": st.session_state["last_question"],
-                    "answer": st.session_state["last_answer"],
-                    "feedback": feedback
-                }
-
                 try:
-                    os.makedirs("logs", exist_ok=True)
-                    log_file = "logs/feedback_log.json"
-
-                    if os.path.exists(log_file):
-                        with open(log_file, "r") as f:
-                            existing_logs = json.load(f)
-                    else:
-                        existing_logs = []
-
-                    existing_logs.append(log_entry)
-
-                    with open(log_file, "w") as f:
-                        json.dump(existing_logs, f, indent=2)
+                    # 👍 answers are served directly the next time the question is asked
+                    log_entry = feedback_store.add(
+                        st.session_state["last_question"],
+                        st.session_state["last_answer"],
+                        feedback
+                    )
+                    if feedback == "negative":
+                        # Stop serving the rejected answer from the answer cache
+                        answer_cache.invalidate(st.session_state["last_question"])
 
                     st.success(f"✅ Feedback recorded as '{feedback}'")
                     st.write("📝 Log entry:", log_entry)
@@ -85,10 +77,19 @@ with tab1:
 with tab2:
     st.subheader("📁 View Collected Feedback")
     try:
-        with open("logs/feedback_log.json", "r") as f:
-            feedback_logs = json.load(f)
-        st.success("Loaded feedback log.")
-        st.dataframe(pd.DataFrame(feedback_logs))
+        total_feedback = feedback_store.count()
+        if total_feedback:
+            # Only the visible page is read from the feedback store
+            col1, col2 = st.columns(2)
+            with col1:
+                page_size = st.selectbox("Entries per page", [25, 50, 100, 250], index=1)
+            total_pages = (total_feedback - 1) // page_size + 1
+            with col2:
+                page_number = st.number_input(f"Page (1–{total_pages})", min_value=1, max_value=total_pages, value=1)
+            st.success(f"Loaded feedback log: {total_feedback} entries.")
+            st.dataframe(pd.DataFrame(feedback_store.page(offset=(page_number - 1) * page_size, limit=page_size)))
+        else:
+            st.info("No feedback collected yet.")
     except Exception as e:
         st.warning("No feedback log found or error loading.")
         st.text(str(e))
@@ -103,18 +104,38 @@ with tab3:
     st.caption(f"📘 Benchmarking from {total_math} math questions")
 
     num_questions = st.slider("Select number of math questions to benchmark", min_value=3, max_value=total_math, value=10)
+    num_workers = st.slider("Parallel workers", min_value=1, max_value=16, value=4)
+    resume_run = st.checkbox("Resume from existing results file", value=False)
 
     if st.button("▶️ Run Benchmark Now"):
         with st.spinner(f"Benchmarking {num_questions} math questions..."):
-            df_result, accuracy = benchmark_math_agent(limit=num_questions)
-
-            # Save the result
-            os.makedirs("benchmark", exist_ok=True)
+            # Results are written incrementally to the CSV while the benchmark runs
             result_path = f"benchmark/results_math_{num_questions}.csv"
-            df_result.to_csv(result_path, index=False)
+            df_result, accuracy = benchmark_math_agent(limit=num_questions, workers=num_workers,
+                                                       output_path=result_path, resume=resume_run)
 
             # Show result
             st.success(f"✅ Done! Accuracy: {accuracy:.2f}%")
             st.metric("Accuracy", f"{accuracy:.2f}%")
             st.dataframe(df_result)
-            st.download_button("Download Results", data=df_result.to_csv(index=False), file_name=result_path, mime="text/csv")
\ No newline at end of file
+            st.download_button("Download Results", data=df_result.to_csv(index=False), file_name=result_path, mime="text/csv")
+
+    # ---- Per-stage latency breakdown of a saved results file ---- #
+    st.markdown("### ⏱️ Latency Breakdown")
+    result_files = sorted(f for f in os.listdir("benchmark") if f.endswith(".csv")) if os.path.isdir("benchmark") else []
+    if result_files:
+        selected_file = st.selectbox("Results file", result_files)
+        df_saved = pd.read_csv(os.path.join("benchmark", selected_file))
+        stage_cols = [c for c in STAGE_COLUMNS if c in df_saved]
+
+        if stage_cols:
+            summary = stage_latency_summary(df_saved)
+            st.dataframe(summary)
+            st.markdown("**p50 / p95 / p99 per stage (seconds)**")
+            st.bar_chart(summary.set_index("Stage")[["P50Sec", "P95Sec", "P99Sec"]], stack=False)
+            st.markdown("**Per-question time by stage (seconds)**")
+            st.bar_chart(df_saved[stage_cols].fillna(0).rename(columns=lambda c: c[:-3]))
+        else:
+            st.info("This results file has no per-stage timings. Re-run the benchmark to record them.")
+    else:
+        st.info("No saved benchmark results yet.")
\ No newline at end of file
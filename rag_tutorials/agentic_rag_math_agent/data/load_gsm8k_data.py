@@ -1,9 +1,63 @@
+import os
+import hashlib
 import pandas as pd
+import pyarrow.parquet as pq
+
+JEEBENCH_URL = "hf://datasets/daman1209arora/jeebench/test.json"
+# Local columnar copy: downloaded once, checksum-validated, memory-mapped on load
+JEEBENCH_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "jeebench.parquet")
+
+_validated = set()
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _cache_is_valid(path: str) -> bool:
+    checksum_path = f"{path}.sha256"
+    if not (os.path.exists(path) and os.path.exists(checksum_path)):
+        return False
+    with open(checksum_path, "r") as f:
+        return f.read().strip() == _sha256(path)
+
+def ensure_jeebench_cache(path: str = JEEBENCH_CACHE, refresh: bool = False) -> str:
+    """Download JEEBench into a local Parquet file unless a valid copy already exists."""
+    if not refresh and (path in _validated or _cache_is_valid(path)):
+        _validated.add(path)
+        return path
+
+    print(f"⬇️ Downloading JEEBench to {path} ...")
+    df = pd.read_json(JEEBENCH_URL)
+    df = df.rename_axis("row_id").reset_index()
+    df["subject"] = df["subject"].str.lower()  # lets the subject filter be pushed down as a plain equality
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    with open(f"{path}.sha256", "w") as f:
+        f.write(_sha256(path))
+    _validated.add(path)
+    return path
+
+def load_jeebench_frame(subject: str | None = None, columns: list[str] | None = None, path: str = JEEBENCH_CACHE):
+    """Read the cached dataset (memory-mapped), optionally filtered by subject at scan time."""
+    ensure_jeebench_cache(path)
+    if columns is not None and "row_id" not in columns:
+        columns = ["row_id"] + columns
+    filters = [("subject", "==", subject.lower())] if subject else None
+    table = pq.read_table(path, columns=columns, filters=filters, memory_map=True)
+    df = table.to_pandas().set_index("row_id")
+    df.index.name = None
+    return df
 
 def load_jeebench_dataset():
-    df = pd.read_json("hf://datasets/daman1209arora/jeebench/test.json")
-    df = df[df["subject"].str.lower() == "math"]
+    df = load_jeebench_frame(subject="math", columns=["question", "gold"])
     return df[['question', 'gold']]
 
 if __name__ == "__main__":
-    load_jeebench_dataset()
+    ensure_jeebench_cache(refresh=True)
+    print(f"✅ Cached {len(load_jeebench_dataset())} math questions at {JEEBENCH_CACHE}")
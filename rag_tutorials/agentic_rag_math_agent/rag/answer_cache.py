@@ -0,0 +1,188 @@
+# rag/answer_cache.py
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from dotenv import load_dotenv
+
+from rag.cache import DiskCache, normalize_text, hash_key
+from rag.cassette import record_or_replay
+from rag.clients import get_embed_model
+
+load_dotenv("config/.env")
+
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "cache/answers.sqlite")
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_TTL_HOURS = float(os.getenv("ANSWER_CACHE_TTL_HOURS", "168"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+
+# Numbers, LaTeX commands, function names, operation words, single-letter variables and operators:
+# the parts of a math question that embeddings barely see ("x^2" vs "x^3", "sin" vs "cos" and
+# "derivative" vs "integral" all score far above the similarity threshold)
+MATH_FUNCTIONS = r"a?(?:sin|cos|tan|cot|sec|csc)h?|log|ln|exp|sqrt|abs|floor|ceil|max|min|gcd|lcm"
+MATH_OPERATIONS = (
+    r"derivatives?|differentiat\w*|integra\w*|limits?|sums?|products?|differences?|quotients?|factori\w*|"
+    r"roots?|squares?|cubes?|powers?|inverses?|determinants?|eigen\w*|transpose|slopes?|tangents?|normals?|"
+    r"areas?|perimeters?|circumferences?|volumes?|surface|diameters?|radius|radii|heights?|lengths?|angles?|"
+    r"distances?|mean|median|mode|variance|deviation|probability|permutations?|combinations?|"
+    r"maxim\w*|minim\w*|remainders?|divisors?|multiples?|primes?|solve|simplify|expand|evaluate"
+)
+MATH_TOKENS = re.compile(
+    rf"\\[a-z]+|\b(?:{MATH_FUNCTIONS}|{MATH_OPERATIONS})\b|\d+(?:\.\d+)?|\b[a-z]\b|[+\-*/^=<>]"
+)
+
+
+def math_signature(normalized: str) -> tuple:
+    return tuple(MATH_TOKENS.findall(normalized))
+
+
+@lru_cache(maxsize=1024)
+def embed_text(text: str):
+    """OpenAI embedding of `text` (memoized, recorded/replayed by the cassette)."""
+    return record_or_replay("embedding", text, lambda: get_embed_model().get_query_embedding(text))
+
+
+def embed_texts(texts):
+    """OpenAI embeddings of many texts in one request (recorded/replayed by the cassette)."""
+    texts = list(texts)
+    return record_or_replay("embedding_batch", texts, lambda: get_embed_model().get_text_embedding_batch(texts))
+
+
+class AnswerCache:
+    """Two-tier answer cache: exact match on normalized question text, then
+    near-duplicate match on question embeddings (cosine >= similarity_threshold).
+    A near-duplicate is only served when both questions have the same math signature
+    (numbers, variables, functions, operation words, LaTeX tokens and operators), so rewordings
+    hit but changed values, functions or operations miss.
+    """
+
+    def __init__(self, path: str = ANSWER_CACHE_PATH, max_entries: int = ANSWER_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float | None = ANSWER_CACHE_TTL_HOURS * 3600,
+                 similarity_threshold: float = ANSWER_CACHE_SIMILARITY, embed_fn=None):
+        self.store = DiskCache(path, max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.similarity_threshold = similarity_threshold
+        self.embed_fn = embed_fn or embed_text
+        self.enabled = True
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._keys = None          # row keys of the in-memory embedding matrix
+        self._matrix = None        # L2-normalized question embeddings
+        self._recent_embeddings = OrderedDict()
+
+    def _embed(self, text: str, vector=None):
+        # Keep the embedding from a miss so store() does not pay for it twice;
+        # `vector` is an embedding of `text` the caller already computed
+        if vector is None and text in self._recent_embeddings:
+            return self._recent_embeddings[text]
+        vector = np.array(self.embed_fn(text) if vector is None else vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        self._recent_embeddings[text] = vector
+        if len(self._recent_embeddings) > 256:
+            self._recent_embeddings.popitem(last=False)
+        return vector
+
+    def _load_matrix(self):
+        with self._lock:
+            if self._matrix is None:
+                rows = [(key, entry["embedding"]) for key, entry in self.store.items() if entry.get("embedding")]
+                self._keys = [key for key, _ in rows]
+                self._matrix = np.asarray([emb for _, emb in rows], dtype=np.float32) if rows else np.zeros((0, 0), dtype=np.float32)
+            return self._keys, self._matrix
+
+    def lookup_exact(self, question: str):
+        """Exact-tier lookup only (no embedding); a miss here is not counted."""
+        if not self.enabled:
+            return None
+        entry = self.store.get(hash_key(normalize_text(question)))
+        if entry is None or entry.get("verdict") is False:
+            return None
+        self.exact_hits += 1
+        return {**entry, "match": "exact", "similarity": 1.0}
+
+    def lookup(self, question: str, embedding=None):
+        """Return the cached entry dict (answer, source, verdict, match) or None.
+        `embedding` is an optional precomputed embedding of normalize_text(question)."""
+        if not self.enabled:
+            return None
+        cached = self.lookup_exact(question)
+        if cached:
+            return cached
+
+        normalized = normalize_text(question)
+        if embedding is not None:
+            self._embed(normalized, embedding)  # remembered for the matrix product and store_answer()
+        try:
+            keys, matrix = self._load_matrix()
+            if len(keys):
+                scores = matrix @ self._embed(normalized)
+                signature = math_signature(normalized)
+                candidates = np.flatnonzero(scores >= self.similarity_threshold)
+                for row in candidates[np.argsort(-scores[candidates])]:
+                    entry = self.store.get(keys[row])
+                    if entry is None:
+                        self._matrix = None  # evicted since the matrix was built
+                        continue
+                    if entry.get("verdict") is not False and math_signature(normalize_text(entry["question"])) == signature:
+                        self.semantic_hits += 1
+                        return {**entry, "match": "semantic", "similarity": float(scores[row])}
+        except Exception as e:
+            print("⚠️ Answer cache similarity lookup skipped:", e)
+
+        self.misses += 1
+        return None
+
+    def store_answer(self, question: str, answer: str, source: str, verdict: bool | None):
+        # Answers the output guard rejected (and the unvalidated web retry that follows) are never cached
+        if not self.enabled or verdict is False:
+            return
+        normalized = normalize_text(question)
+        try:
+            vector = self._embed(normalized)
+        except Exception as e:
+            print("⚠️ Answer cache stored without embedding:", e)
+            vector = None
+
+        key = hash_key(normalized)
+        self.store.set(key, {
+            "question": question,
+            "answer": answer,
+            "source": source,
+            "verdict": verdict,
+            "embedding": vector.tolist() if vector is not None else None,
+            "cached_at": time.time(),
+        })
+        with self._lock:
+            if self._matrix is not None and vector is not None:
+                if key in self._keys:
+                    self._matrix[self._keys.index(key)] = vector
+                elif len(self._keys) == 0:
+                    self._keys, self._matrix = [key], vector[None, :]
+                else:
+                    self._keys.append(key)
+                    self._matrix = np.vstack([self._matrix, vector])
+
+    def invalidate(self, question: str):
+        """Drop the cached answer for `question`, e.g. after a 👎 rating."""
+        key = hash_key(normalize_text(question))
+        self.store.delete(key)
+        with self._lock:
+            if self._matrix is not None and key in self._keys:
+                row = self._keys.index(key)
+                self._keys.pop(row)
+                self._matrix = np.delete(self._matrix, row, axis=0)
+
+    def stats(self) -> dict:
+        total = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.semantic_hits) / total if total else 0.0,
+            "entries": len(self.store),
+        }
@@ -0,0 +1,109 @@
+# rag/cassette.py
+import os
+import json
+import time
+import atexit
+import threading
+
+from rag.cache import hash_key
+
+# off    → call the real services
+# record → call the real services and append every response to the cassette file (one JSON line each)
+# replay → serve responses from the cassette file, no network access
+CASSETTE_MODE = os.getenv("MATH_AGENT_CASSETTE_MODE", "off")
+CASSETTE_PATH = os.getenv("MATH_AGENT_CASSETTE_PATH", "benchmark/cassette.jsonl")
+# Replay latency: unset = none, "recorded" = the latency measured while recording, or fixed seconds (e.g. "0.2")
+CASSETTE_LATENCY = os.getenv("MATH_AGENT_CASSETTE_LATENCY")
+
+
+class CassetteMiss(KeyError):
+    """Raised in replay mode when a call was never recorded."""
+
+
+class Cassette:
+    """Records external call responses (LLM, guardrails, embeddings, Tavily, Qdrant)
+    keyed by call kind + input, and replays them deterministically."""
+
+    def __init__(self, path: str = CASSETTE_PATH, mode: str = CASSETTE_MODE, latency=CASSETTE_LATENCY):
+        if mode not in ("off", "record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+        if mode != "off" and os.path.exists(path):
+            self._load()
+        elif mode == "replay":
+            raise FileNotFoundError(f"Cassette file not found: {path}")
+
+        if mode == "record":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a")
+            atexit.register(self.close)
+
+    def _load(self):
+        with open(self.path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "id" in record and "response" in record:
+                    self.entries[record.pop("id")] = record  # later lines win when a call was re-recorded
+                else:
+                    self.entries.update(record)  # older cassettes: one JSON object of id → entry
+
+    def call(self, kind: str, key, fn):
+        if self.mode == "off":
+            return fn()
+
+        call_id = hash_key(kind, key if isinstance(key, str) else json.dumps(key, sort_keys=True))
+
+        if self.mode == "replay":
+            entry = self.entries.get(call_id)
+            if entry is None:
+                raise CassetteMiss(f"No recorded '{kind}' response in {self.path}")
+            self._sleep(entry["latency"])
+            return entry["response"]
+
+        start = time.perf_counter()
+        response = fn()
+        entry = {"kind": kind, "response": response, "latency": round(time.perf_counter() - start, 4)}
+        line = json.dumps({"id": call_id, **entry})
+        # Append one line per call instead of rewriting the whole cassette
+        with self._lock:
+            self.entries[call_id] = entry
+            self._file.write(line + "\n")
+            self._file.flush()
+        return response
+
+    def _sleep(self, recorded_latency: float):
+        if not self.latency:
+            return
+        delay = recorded_latency if self.latency == "recorded" else float(self.latency)
+        time.sleep(delay)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+_active = Cassette()
+
+
+def use_cassette(path: str = CASSETTE_PATH, mode: str = "replay", latency=None):
+    """Switch the process-wide cassette (e.g. from the benchmark CLI)."""
+    global _active
+    _active.close()
+    _active = Cassette(path, mode, latency)
+    print(f"📼 Cassette {mode}: {path}")
+    return _active
+
+
+def record_or_replay(kind: str, key, fn):
+    """Run fn() through the active cassette. Responses must be JSON-serializable."""
+    return _active.call(kind, key, fn)
@@ -0,0 +1,83 @@
+# rag/feedback_store.py
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from rag.cache import normalize_text, hash_key
+
+FEEDBACK_DB_PATH = os.getenv("FEEDBACK_DB_PATH", "logs/feedback.sqlite")
+# Earlier versions appended every rating to this JSON file; it is imported once into the store
+LEGACY_FEEDBACK_LOG = "logs/feedback_log.json"
+
+
+def question_hash(question: str) -> str:
+    return hash_key(normalize_text(question))
+
+
+class FeedbackStore:
+    """Thumbs-up/down ratings in SQLite, indexed by normalized question hash."""
+
+    def __init__(self, path: str = FEEDBACK_DB_PATH, legacy_log: str | None = LEGACY_FEEDBACK_LOG):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS feedback ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, question_hash TEXT NOT NULL, question TEXT NOT NULL, "
+            "answer TEXT NOT NULL, feedback TEXT NOT NULL CHECK (feedback IN ('positive', 'negative')), "
+            "created_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_feedback_question ON feedback(question_hash, feedback)")
+        self._conn.commit()
+
+        if legacy_log and os.path.exists(legacy_log) and self.count() == 0:
+            self._import_legacy_log(legacy_log)
+
+    def _import_legacy_log(self, legacy_log: str):
+        with open(legacy_log, "r") as f:
+            entries = json.load(f)
+        for entry in entries:
+            self.add(entry["question"], entry["answer"], entry["feedback"])
+        print(f"📥 Imported {len(entries)} feedback entries from {legacy_log}")
+
+    def add(self, question: str, answer: str, feedback: str) -> dict:
+        entry = {"question": question, "answer": answer, "feedback": feedback, "created_at": time.time()}
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO feedback (question_hash, question, answer, feedback, created_at) VALUES (?, ?, ?, ?, ?)",
+                (question_hash(question), question, answer, feedback, entry["created_at"]),
+            )
+            self._conn.commit()
+        return entry
+
+    def verified_answer(self, question: str):
+        """Best positively rated answer for this question (more 👍 than 👎, most recent first), or None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT answer, SUM(feedback = 'positive') AS pos, SUM(feedback = 'negative') AS neg, MAX(id) AS last "
+                "FROM feedback WHERE question_hash = ? GROUP BY answer HAVING pos > neg "
+                "ORDER BY pos - neg DESC, last DESC LIMIT 1",
+                (question_hash(question),),
+            ).fetchone()
+        return row[0] if row else None
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+
+    def page(self, offset: int = 0, limit: int = 50):
+        """One page of entries, newest first; only that page is read from disk."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, question, answer, feedback, created_at FROM feedback ORDER BY id DESC LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+        return [
+            {"id": row[0], "question": row[1], "answer": row[2], "feedback": row[3], "created_at": row[4]}
+            for row in rows
+        ]
@@ -1,15 +1,27 @@
 import dspy
 import os
+import re
+import time
+import random
+import threading
+import numpy as np
 from dotenv import load_dotenv
+from rag.cache import DiskCache, hash_key, normalize_text
 
-# Load API key
+# The DSPy LM is configured once by rag.clients.get_dspy_lm(); build validators via
+# rag.clients.get_input_validator() / get_output_validator() to share a single instance.
 load_dotenv("config/.env")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-print("🔐 Loaded OPENAI_API_KEY:", "✅ Found" if OPENAI_API_KEY else "❌ Missing")
 
-# Configure LM
-lm = dspy.LM(model="gpt-4o", api_key=OPENAI_API_KEY)
-dspy.configure(lm=lm)
+# Local fast path in front of the LLM input guard
+INPUT_FASTPATH_ENABLED = os.getenv("INPUT_FASTPATH_ENABLED", "1") == "1"
+INPUT_FASTPATH_YES_SIMILARITY = float(os.getenv("INPUT_FASTPATH_YES_SIMILARITY", "0.90"))
+INPUT_FASTPATH_NO_SIMILARITY = float(os.getenv("INPUT_FASTPATH_NO_SIMILARITY", "0.92"))
+# Fraction of fast-path decisions that are also sent to the LLM to measure agreement
+INPUT_FASTPATH_SHADOW_RATE = float(os.getenv("INPUT_FASTPATH_SHADOW_RATE", "0.05"))
+
+# On-disk cache of OutputValidator verdicts, keyed by hash(question, answer)
+VERDICT_CACHE_PATH = os.getenv("VERDICT_CACHE_PATH", "cache/output_verdicts.sqlite")
+VERDICT_CACHE_MAX_ENTRIES = int(os.getenv("VERDICT_CACHE_MAX_ENTRIES", "20000"))
 
 # ✅ Signature for Input Guard
 class ClassifyMath(dspy.Signature):
@@ -24,59 +36,210 @@ class ClassifyMath(dspy.Signature):
 
 
 
+# ✅ Few-shot examples for the input guard (also the reference set for the local fast path)
+INPUT_EXAMPLES = [
+    {"question": "What is the derivative of x^2?", "verdict": "Yes"},
+    {"question": "Explain the chain rule in calculus.", "verdict": "Yes"},
+    {"question": "Why do I need to learn algebra?", "verdict": "Yes"},
+    {"question": "What is the Pythagorean theorem?", "verdict": "Yes"},
+    {"question": "How do I solve a quadratic equation?", "verdict": "Yes"},
+    {"question": "What is the area of a circle?", "verdict": "Yes"},
+    {"question": "How is math used in real life?", "verdict": "Yes"},
+    {"question": "What is the purpose of trigonometry?", "verdict": "Yes"},
+    {"question": "What is the Fibonacci sequence?", "verdict": "Yes"},
+    {"question": "can you tell me about rhombus?", "verdict": "Yes"},
+    {"question": "what is a circle?", "verdict": "Yes"},
+    {"question": "What is the formula for the area of a circle?", "verdict": "Yes"},
+    {"question": "What is the formula for the circumference of a circle?", "verdict": "Yes"},
+    {"question": "What is the formula for the volume of a cone?", "verdict": "Yes"},
+    {"question": "What is the formula for the area of a parallelogram?", "verdict": "Yes"},
+    {"question": "What is the formula for the area of a trapezoid?", "verdict": "Yes"},
+    {"question": "What is the formula for the surface area of a cube?", "verdict": "Yes"},
+    {"question": "What is the area of parallelogram?", "verdict": "Yes"},
+    {"question": "What is a square?", "verdict": "Yes"},
+    {"question": "Explain rectangle?", "verdict": "Yes"},
+    {"question": "can you tell me about pentagon?", "verdict": "Yes"},
+    {"question": "What is the formula for the volume of a sphere?", "verdict": "Yes"},
+    {"question": "What is the difference between a mean and median?", "verdict": "Yes"},
+    {"question": "What is the formula for the area of a triangle?", "verdict": "Yes"},
+    {"question": "What is the difference between a permutation and a combination?", "verdict": "Yes"},
+    {"question": "What is the formula for the slope of a line?", "verdict": "Yes"},
+    {"question": "What is the difference between a rational and irrational number?", "verdict": "Yes"},
+    {"question": "What is the formula for the area of a rectangle?", "verdict": "Yes"},
+    {"question": "What is the formula for the volume of a cylinder?", "verdict": "Yes"},
+    {"question": "What is the formula for the area of a trapezoid?", "verdict": "Yes"},
+    {"question": "What is the formula for the surface area of a sphere?", "verdict": "Yes"},
+    {"question": "What is the formula for the surface area of a cylinder?", "verdict": "Yes"},
+    {"question": "What is the integral of sin(x)?", "verdict": "Yes"},
+    {"question": "What is the difference between mean and median?", "verdict": "Yes"},
+    {"question": "What is the formula for the circumference of a circle?", "verdict": "Yes"},
+    {"question": "What is the quadratic formula?", "verdict": "Yes"},   
+    {"question": "Tell me a good movie to watch.", "verdict": "No"},
+    {"question": "What is AI?", "verdict": "No"},
+]
+
+# ✅ Local pre-classifier for the input guard
+# Only unambiguous notation decides locally; everything else goes to the embedding check or the LLM.
+# "$...$" must contain a variable or LaTeX, "=" needs a number/variable/bracket on both sides (not
+# "timeout=30"), and "-" or "/" between bare numbers must be spaced ("2023-2024", "555-1234", "1/2 cup" are not math)
+MATH_SYMBOLS = re.compile(
+    r"[√π∑∏∫∞≤≥≠±×÷∂∆θ]|\\(frac|sqrt|int|sum|sin|cos|tan|log|lim|pi|theta|alpha|beta|cdot|mathbf|mathrm|left|right)\b"
+    r"|\$(?!\s)[^$\n]*[a-zA-Z\\^_{}][^$\n]*(?<!\s)\$"
+    r"|(?:(?<![A-Za-z_.])[a-zA-Z]|(?<![\w.])\d+(?:\.\d+)?|[)\]}])\s*=\s*(?:-?\d|[a-zA-Z](?![a-zA-Z])|[(\[{\\])"
+)
+ARITHMETIC = re.compile(
+    r"\d\s*[+*^×]\s*\(?\s*[\dxyz]|\d\s+[-/]\s+\(?\s*[\dxyz]"
+    r"|\b\d*[xyz]\s*[-+*/^]\s*\(?\s*[\dxyz]\b|\b(sin|cos|tan|log|ln|exp)\s*\("
+)
+
+class MathPreClassifier:
+    """Answers obvious input-guard cases locally and returns None when unsure.
+
+    1. Lexical heuristics: LaTeX/math symbols, equations and arithmetic on numbers or variables.
+    2. Embedding nearest neighbour against INPUT_EXAMPLES.
+    """
+
+    def __init__(self, examples=INPUT_EXAMPLES, yes_similarity: float = INPUT_FASTPATH_YES_SIMILARITY,
+                 no_similarity: float = INPUT_FASTPATH_NO_SIMILARITY, embed_fn=None):
+        self.examples = examples
+        self.yes_similarity = yes_similarity
+        self.no_similarity = no_similarity
+        self.embed_fn = embed_fn
+        self._example_matrix = None
+        self._lock = threading.Lock()
+
+    def _lexical(self, question: str):
+        if MATH_SYMBOLS.search(question) or ARITHMETIC.search(question):
+            return True
+        return None
+
+    def _embed(self, text: str, vector=None):
+        # Same normalized text as the answer cache, so both share one embedding per question
+        if vector is None:
+            if self.embed_fn is None:
+                from rag.answer_cache import embed_text
+                self.embed_fn = embed_text
+            vector = self.embed_fn(normalize_text(text))
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _nearest_example(self, question: str, embedding=None):
+        with self._lock:
+            if self._example_matrix is None:
+                self._example_matrix = np.stack([self._embed(ex["question"]) for ex in self.examples])
+        scores = self._example_matrix @ self._embed(question, embedding)
+        best = int(np.argmax(scores))
+        return self.examples[best]["verdict"].lower() == "yes", float(scores[best])
+
+    def classify(self, question: str, embedding=None):
+        """Return True/False when confident, None for the uncertain band.
+        `embedding` is an optional precomputed embedding of normalize_text(question)."""
+        if self._lexical(question):
+            return True
+        try:
+            is_math, similarity = self._nearest_example(question, embedding)
+        except Exception as e:
+            print("⚠️ Input fast path embedding skipped:", e)
+            return None
+        if is_math and similarity >= self.yes_similarity:
+            return True
+        if not is_math and similarity >= self.no_similarity:
+            return False
+        return None
+
+
 # ✅ Input Validator
 class InputValidator(dspy.Module):
-    def __init__(self):
+    def __init__(self, use_fast_path: bool = INPUT_FASTPATH_ENABLED, shadow_rate: float = INPUT_FASTPATH_SHADOW_RATE):
         super().__init__()
         self.classifier = dspy.Predict(ClassifyMath)
         self.validate_question = dspy.ChainOfThought(
             ClassifyMath,
-            examples=[
-                {"question": "What is the derivative of x^2?", "verdict": "Yes"},
-                {"question": "Explain the chain rule in calculus.", "verdict": "Yes"},
-                {"question": "Why do I need to learn algebra?", "verdict": "Yes"},
-                {"question": "What is the Pythagorean theorem?", "verdict": "Yes"},
-                {"question": "How do I solve a quadratic equation?", "verdict": "Yes"},
-                {"question": "What is the area of a circle?", "verdict": "Yes"},
-                {"question": "How is math used in real life?", "verdict": "Yes"},
-                {"question": "What is the purpose of trigonometry?", "verdict": "Yes"},
-                {"question": "What is the Fibonacci sequence?", "verdict": "Yes"},
-                {"question": "can you tell me about rhombus?", "verdict": "Yes"},
-                {"question": "what is a circle?", "verdict": "Yes"},
-                {"question": "What is the formula for the area of a circle?", "verdict": "Yes"},
-                {"question": "What is the formula for the circumference of a circle?", "verdict": "Yes"},
-                {"question": "What is the formula for the volume of a cone?", "verdict": "Yes"},
-                {"question": "What is the formula for the area of a parallelogram?", "verdict": "Yes"},
-                {"question": "What is the formula for the area of a trapezoid?", "verdict": "Yes"},
-                {"question": "What is the formula for the surface area of a cube?", "verdict": "Yes"},
-                {"question": "What is the area of parallelogram?", "verdict": "Yes"},
-                {"question": "What is a square?", "verdict": "Yes"},
-                {"question": "Explain rectangle?", "verdict": "Yes"},
-                {"question": "can you tell me about pentagon?", "verdict": "Yes"},
-                {"question": "What is the formula for the volume of a sphere?", "verdict": "Yes"},
-                {"question": "What is the difference between a mean and median?", "verdict": "Yes"},
-                {"question": "What is the formula for the area of a triangle?", "verdict": "Yes"},
-                {"question": "What is the difference between a permutation and a combination?", "verdict": "Yes"},
-                {"question": "What is the formula for the slope of a line?", "verdict": "Yes"},
-                {"question": "What is the difference between a rational and irrational number?", "verdict": "Yes"},
-                {"question": "What is the formula for the area of a rectangle?", "verdict": "Yes"},
-                {"question": "What is the formula for the volume of a cylinder?", "verdict": "Yes"},
-                {"question": "What is the formula for the area of a trapezoid?", "verdict": "Yes"},
-                {"question": "What is the formula for the surface area of a sphere?", "verdict": "Yes"},
-                {"question": "What is the formula for the surface area of a cylinder?", "verdict": "Yes"},
-                {"question": "What is the integral of sin(x)?", "verdict": "Yes"},
-                {"question": "What is the difference between mean and median?", "verdict": "Yes"},
-                {"question": "What is the formula for the circumference of a circle?", "verdict": "Yes"},
-                {"question": "What is the quadratic formula?", "verdict": "Yes"},   
-                {"question": "Tell me a good movie to watch.", "verdict": "No"},
-                {"question": "What is AI?", "verdict": "No"},
-            ]
+            examples=INPUT_EXAMPLES
         )
-    def forward(self, question):
+        self.fast_path = MathPreClassifier() if use_fast_path else None
+        self.shadow_rate = shadow_rate
+        self.stats = {"fast": 0, "llm": 0, "fast_sec": 0.0, "llm_sec": 0.0, "shadowed": 0, "agreed": 0}
+        self._stats_lock = threading.Lock()  # classify() runs on many threads at once
+
+    def _count(self, **deltas):
+        with self._stats_lock:
+            for name, delta in deltas.items():
+                self.stats[name] += delta
+
+    def _llm_verdict(self, question):
+        start = time.perf_counter()
         response = self.classifier(question=question)
+        self._count(llm=1, llm_sec=time.perf_counter() - start)
         print("🧠 InputValidator Response:", response.verdict)
         return response.verdict.lower().strip() == "yes"
 
+    def _fast_verdict(self, question, embedding=None):
+        """Return (verdict or None, shadowed); a shadowed verdict also cost one LLM call."""
+        if self.fast_path is None:
+            return None, False
+        start = time.perf_counter()
+        verdict = self.fast_path.classify(question, embedding)
+        self._count(fast_sec=time.perf_counter() - start)
+        if verdict is None:
+            return None, False
+        self._count(fast=1)
+        print("⚡ InputValidator fast path:", "Yes" if verdict else "No")
+        if self.shadow_rate and random.random() < self.shadow_rate:
+            self._count(shadowed=1, agreed=int(self._llm_verdict(question) == verdict))
+            return verdict, True
+        return verdict, False
+
+    def classify(self, question, use_fast_path: bool = True):
+        """Return (verdict, used_llm); used_llm includes shadow calls made to measure agreement."""
+        verdict, shadowed = self._fast_verdict(question) if use_fast_path else (None, False)
+        if verdict is not None:
+            return verdict, shadowed
+        return self._llm_verdict(question), True
+
+    def forward(self, question, use_fast_path: bool = True):
+        verdict, _ = self.classify(question, use_fast_path)
+        return verdict
+
+    def classify_batch(self, questions, num_threads: int = 8, use_fast_path: bool = True, embeddings=None):
+        """Classify many questions: fast path locally, then one batched DSPy pass for the uncertain rest.
+        Returns (verdict, used_llm) per question, like classify().
+        `embeddings` optionally holds precomputed embeddings of the normalized questions, in order."""
+        embeddings = embeddings if embeddings is not None else [None] * len(questions)
+        fast = [self._fast_verdict(question, embedding) if use_fast_path else (None, False)
+                for question, embedding in zip(questions, embeddings)]
+        verdicts = [verdict for verdict, _ in fast]
+        used_llm = [shadowed for _, shadowed in fast]
+        pending = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        if pending:
+            start = time.perf_counter()
+            examples = [dspy.Example(question=questions[i]).with_inputs("question") for i in pending]
+            responses = self.classifier.batch(examples, num_threads=num_threads)
+            # Failed items are counted by the _llm_verdict retry below
+            self._count(llm=sum(response is not None for response in responses), llm_sec=time.perf_counter() - start)
+            for i, response in zip(pending, responses):
+                # Failed batch items come back as None; classify those one by one
+                verdicts[i] = (response.verdict.lower().strip() == "yes") if response is not None else self._llm_verdict(questions[i])
+                used_llm[i] = True
+        return list(zip(verdicts, used_llm))
+
+    def forward_batch(self, questions, num_threads: int = 8, use_fast_path: bool = True, embeddings=None):
+        return [verdict for verdict, _ in self.classify_batch(questions, num_threads, use_fast_path, embeddings)]
+
+    def fast_path_report(self) -> dict:
+        """Fast-path coverage, agreement with the LLM on shadowed samples, and estimated latency saved."""
+        with self._stats_lock:
+            s = dict(self.stats)
+        total = s["fast"] + s["llm"] - s["shadowed"]
+        avg_llm_sec = s["llm_sec"] / s["llm"] if s["llm"] else 0.0
+        return {
+            "questions": total,
+            "fast_path_rate": s["fast"] / total if total else 0.0,
+            "agreement_rate": s["agreed"] / s["shadowed"] if s["shadowed"] else None,
+            "avg_llm_sec": avg_llm_sec,
+            "latency_saved_sec": max(0.0, s["fast"] * avg_llm_sec - s["fast_sec"]),
+        }
+
 # ✅ Output Validator (no change unless needed)
 class OutputValidator(dspy.Module):
     class ValidateAnswer(dspy.Signature):
@@ -85,18 +248,38 @@ class OutputValidator(dspy.Module):
         answer = dspy.InputField(desc="The model-generated answer.")
         verdict = dspy.OutputField(desc="Answer only 'Yes' or 'No'")
 
-    def __init__(self):
+    def __init__(self, cache_path: str = VERDICT_CACHE_PATH, max_cache_entries: int = VERDICT_CACHE_MAX_ENTRIES):
         super().__init__()
         self.validate_answer = dspy.Predict(self.ValidateAnswer)
+        # Size-bounded LRU; verdicts do not expire because the same (question, answer) is judged the same
+        self.verdict_cache = DiskCache(cache_path, max_entries=max_cache_entries)
+        self.cache_enabled = True
+
+    def validate(self, question, answer):
+        """Return (verdict, used_llm); used_llm is False when the verdict came from the cache."""
+        key = hash_key(question, answer)
+        cached = self.verdict_cache.get(key) if self.cache_enabled else None
+        if cached is not None:
+            print("🧠 OutputValidator Response (cached):", "Yes" if cached else "No")
+            return cached, False
 
-    def forward(self, question, answer):
         response = self.validate_answer(
             question=question,
             answer=answer
         )
         print("🧠 OutputValidator Response:", response.verdict)
-        return response.verdict.lower().strip() == "yes"
+        verdict = response.verdict.lower().strip() == "yes"
+        if self.cache_enabled:
+            self.verdict_cache.set(key, verdict)
+        return verdict, True
+
+    def forward(self, question, answer):
+        verdict, _ = self.validate(question, answer)
+        return verdict
+
+    def reset_cache_stats(self):
+        # Call at the start of a run so verdict_cache_report() covers only that run
+        self.verdict_cache.reset_stats()
 
-# Initialize validators
-input_validator = InputValidator()
-output_validator = OutputValidator()
+    def verdict_cache_report(self) -> dict:
+        return self.verdict_cache.stats()
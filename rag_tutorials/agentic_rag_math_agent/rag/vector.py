@@ -1,54 +1,137 @@
-from llama_index.core import VectorStoreIndex, StorageContext
-from llama_index.core.schema import Document
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
+from llama_index.core.schema import Document, MetadataMode
 from llama_index.core.node_parser import SimpleNodeParser
 from llama_index.vector_stores.qdrant import QdrantVectorStore
 from llama_index.embeddings.openai import OpenAIEmbedding
 from qdrant_client import QdrantClient
 from qdrant_client.models import Distance, VectorParams
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import pandas as pd
-import os
+from data.load_gsm8k_data import load_jeebench_frame
+import argparse
+import hashlib
+import json
+import time
+import uuid
 
 # ✅ Load environment variables
 load_dotenv("config/.env")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+PERSIST_DIR = "storage"
+COLLECTION_NAME = "math_agent"
+# Content hash of every ingested document, so re-runs only embed new or changed ones
+INGEST_MANIFEST = os.path.join(PERSIST_DIR, "ingest_manifest.json")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+
 # ✅ Load JEEBench dataset as Documents
 def load_jeebench_documents():
-    df = pd.read_json("hf://datasets/daman1209arora/jeebench/test.json")
+    df = load_jeebench_frame(columns=["question", "gold"])
     documents = []
-    for i, row in df.iterrows():
-        q = row["question"]
-        a = row["gold"]
+    for i, q, a in zip(df.index, df["question"], df["gold"]):
         text = f"Q: {q}\nA: {a}"
-        doc = Document(text=text, metadata={"source": "jee_bench", "index": i})
+        # Stable id per dataset row so re-ingesting upserts instead of duplicating
+        doc_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"jee_bench/{i}"))
+        doc = Document(text=text, id_=doc_id, metadata={"source": "jee_bench", "index": i})
         documents.append(doc)
     return documents
 
-# ✅ Build the vector index using Qdrant
-def build_vector_index():
-    documents = load_jeebench_documents()
+def content_hash(doc: Document) -> str:
+    return hashlib.sha256(doc.get_content(metadata_mode=MetadataMode.ALL).encode("utf-8")).hexdigest()
 
-    node_parser = SimpleNodeParser()
-    nodes = node_parser.get_nodes_from_documents(documents)
+def _load_manifest(path: str = INGEST_MANIFEST):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def _save_manifest(manifest: dict, path: str = INGEST_MANIFEST):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+
+# ✅ Embed nodes in batches, several batches in flight at once (order preserved)
+def embed_nodes_batched(nodes, embed_model, batch_size: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY):
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        embeddings = [emb for batch in pool.map(embed_model.get_text_embedding_batch, batches) for emb in batch]
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+    return nodes
+
+# ✅ Build (or incrementally update) the vector index using Qdrant
+def build_vector_index(batch_size: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY, force: bool = False):
+    start = time.perf_counter()
+    documents = load_jeebench_documents()
 
     qdrant_client = QdrantClient(host="localhost", port=6333)
-    collection_name = "math_agent"
+    collection_name = COLLECTION_NAME
 
+    manifest = {} if force else _load_manifest()
+    if not manifest and qdrant_client.collection_exists(collection_name=collection_name):
+        # Without a manifest we cannot tell which points belong to which document (older builds used
+        # random point ids), so start from an empty collection instead of upserting next to stale chunks.
+        # The docstore is rebuilt from scratch below and overwrites the persisted one.
+        qdrant_client.delete_collection(collection_name=collection_name)
     if not qdrant_client.collection_exists(collection_name=collection_name):
         qdrant_client.create_collection(
             collection_name=collection_name,
             vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
         )
+        manifest = {}  # nothing is actually stored yet
+
+    hashes = {doc.doc_id: content_hash(doc) for doc in documents}
+    changed = [doc for doc in documents if manifest.get(doc.doc_id) != hashes[doc.doc_id]]
+    removed = [doc_id for doc_id in manifest if doc_id not in hashes]
+
+    node_parser = SimpleNodeParser()
+    nodes = node_parser.get_nodes_from_documents(changed)
+    # Deterministic point ids: chunk k of a document always maps to the same Qdrant point
+    chunk_counts = {}
+    for node in nodes:
+        k = chunk_counts.get(node.ref_doc_id, 0)
+        chunk_counts[node.ref_doc_id] = k + 1
+        node.id_ = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{node.ref_doc_id}/{k}"))
 
     vector_store = QdrantVectorStore(client=qdrant_client, collection_name=collection_name)
     embed_model = OpenAIEmbedding(api_key=OPENAI_API_KEY)
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
-    index = VectorStoreIndex(nodes=nodes, embed_model=embed_model, storage_context=storage_context)
-    index.storage_context.persist()
+    if manifest and os.path.exists(os.path.join(PERSIST_DIR, "index_store.json")):
+        storage_context = StorageContext.from_defaults(persist_dir=PERSIST_DIR, vector_store=vector_store)
+        index = load_index_from_storage(storage_context, embed_model=embed_model)
+    else:
+        storage_context = StorageContext.from_defaults(vector_store=vector_store)
+        index = VectorStoreIndex(nodes=[], embed_model=embed_model, storage_context=storage_context)
+
+    # Drop the old chunks of changed or removed documents before upserting
+    for doc_id in [doc.doc_id for doc in changed if doc.doc_id in manifest] + removed:
+        index.delete_ref_doc(doc_id, delete_from_docstore=True)
+        manifest.pop(doc_id, None)
+
+    if nodes:
+        embed_nodes_batched(nodes, embed_model, batch_size=batch_size, concurrency=concurrency)
+        index.insert_nodes(nodes)
+    index.storage_context.persist(persist_dir=PERSIST_DIR)
+
+    manifest.update({doc.doc_id: hashes[doc.doc_id] for doc in changed})
+    _save_manifest(manifest)
 
+    elapsed = time.perf_counter() - start
     print("✅ Qdrant vector index built and saved successfully.")
+    print(f"📊 {len(documents)} documents in {elapsed:.1f}s ({len(documents) / elapsed:.1f} docs/s): "
+          f"{len(changed)} new/changed ({len(nodes)} chunks embedded), "
+          f"{len(documents) - len(changed)} unchanged (embeddings skipped), {len(removed)} removed")
 
 if __name__ == "__main__":
-    build_vector_index()
+    parser = argparse.ArgumentParser(description="Incrementally ingest JEEBench into the math_agent Qdrant collection.")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Texts per embedding request")
+    parser.add_argument("--concurrency", type=int, default=EMBED_CONCURRENCY, help="Embedding requests in flight")
+    parser.add_argument("--force", action="store_true", help="Ignore the manifest and re-embed every document")
+    args = parser.parse_args()
+    build_vector_index(batch_size=args.batch_size, concurrency=args.concurrency, force=args.force)
@@ -0,0 +1,89 @@
+# rag/web_search.py
+import os
+import threading
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from rag.cache import DiskCache, normalize_text, hash_key
+
+TAVILY_SEARCH_URL = "https://api.tavily.com/search"
+WEB_CACHE_PATH = os.getenv("WEB_CACHE_PATH", "cache/web_search.sqlite")
+WEB_CACHE_TTL_HOURS = float(os.getenv("WEB_CACHE_TTL_HOURS", "24"))
+WEB_CACHE_MAX_ENTRIES = int(os.getenv("WEB_CACHE_MAX_ENTRIES", "5000"))
+WEB_TIMEOUT = (3.05, float(os.getenv("WEB_TIMEOUT_SEC", "20")))  # (connect, read) seconds
+NO_ANSWER = "No answer found."
+
+
+class WebSearchClient:
+    """Tavily search with a keep-alive connection pool, a TTL'd on-disk result cache
+    and in-flight de-duplication (concurrent identical queries share one request)."""
+
+    def __init__(self, api_key: str, cache_path: str = WEB_CACHE_PATH, ttl_seconds: float = WEB_CACHE_TTL_HOURS * 3600,
+                 max_entries: int = WEB_CACHE_MAX_ENTRIES, timeout=WEB_TIMEOUT, pool_size: int = 10):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.cache = DiskCache(cache_path, max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.requests_sent = 0
+        self.deduplicated = 0
+
+        self.session = requests.Session()
+        retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["POST"])
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+        self.session.headers.update({"Content-Type": "application/json"})
+
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _post(self, query: str):
+        payload = {
+            "api_key": self.api_key,
+            "query": query,
+            "search_depth": "basic",
+            "include_answer": True,
+            "include_raw_content": False
+        }
+        self.requests_sent += 1
+        response = self.session.post(TAVILY_SEARCH_URL, json=payload, timeout=self.timeout)
+        data = response.json()
+        return data.get("answer"), response.ok
+
+    def search(self, query: str) -> str:
+        key = hash_key(normalize_text(query))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached["answer"]
+
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+        if not owner:
+            self.deduplicated += 1
+            return future.result()
+
+        try:
+            # Another request may have filled the cache between our lookup and registering
+            cached = self.cache.get(key)
+            if cached is not None:
+                answer = cached["answer"]
+            else:
+                answer, ok = self._post(query)
+                if ok and answer:
+                    self.cache.set(key, {"query": query, "answer": answer})
+                answer = answer or NO_ANSWER
+            future.set_result(answer)
+            return answer
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        return {**self.cache.stats(), "requests_sent": self.requests_sent, "deduplicated": self.deduplicated}
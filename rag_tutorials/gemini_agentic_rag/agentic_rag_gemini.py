@@ -1,10 +1,14 @@
 import os
+import time
+import random
 import tempfile
 from datetime import datetime
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import bs4
 from agno.agent import Agent
 from agno.models.google import Gemini
@@ -15,15 +19,53 @@ from qdrant_client import QdrantClient
 from qdrant_client.models import Distance, VectorParams
 from langchain_core.embeddings import Embeddings
 from agno.tools.exa import ExaTools
+from embedding_cache import CachedEmbeddings
+
+
+# 嵌入批处理参数
+EMBED_BATCH_SIZE = int(os.getenv("GEMINI_EMBED_BATCH_SIZE", "100"))  # 每次批量请求的文本块数（API上限为100）
+EMBED_CONCURRENCY = int(os.getenv("GEMINI_EMBED_CONCURRENCY", "4"))  # 同时进行的批量请求数
+EMBED_MAX_RETRIES = 5  # 配额不足或服务暂时不可用时的最大重试次数
+# 可重试的错误：429配额耗尽，以及服务端的临时故障
+RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
 
 
 class GeminiEmbedder(Embeddings):
-    def __init__(self, model_name="models/text-embedding-004"):
+    def __init__(self, model_name="models/text-embedding-004", batch_size: int = EMBED_BATCH_SIZE,
+                 concurrency: int = EMBED_CONCURRENCY):
         genai.configure(api_key=st.session_state.google_api_key)
         self.model = model_name
+        self.batch_size = max(1, min(batch_size, 100))
+        self.concurrency = max(1, concurrency)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """一次批量请求嵌入多个文本块，遇到配额或临时错误时指数退避重试"""
+        for attempt in range(EMBED_MAX_RETRIES + 1):
+            try:
+                response = genai.embed_content(
+                    model=self.model,
+                    content=texts,
+                    task_type="retrieval_document"
+                )
+                return response['embedding']
+            except RETRYABLE_ERRORS:
+                if attempt == EMBED_MAX_RETRIES:
+                    raise
+                # 加入随机抖动，避免多个线程同时重试再次触发限流
+                time.sleep(min(2 ** attempt, 30) + random.uniform(0, 1))
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return [self.embed_query(text) for text in texts]
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1:
+            return [embedding for batch in batches for embedding in self._embed_batch(batch)]
+        # 最多concurrency个批量请求同时进行；pool.map按提交顺序返回，输出与输入顺序一致
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as pool:
+            return [embedding for result in pool.map(self._embed_batch, batches) for embedding in result]
 
     def embed_query(self, text: str) -> List[float]:
         response = genai.embed_content(
@@ -206,16 +248,21 @@ def create_vector_store(client, texts):
                 raise e
 
         # 初始化向量存储
+        embedder = GeminiEmbedder()
+        # 按内容寻址的嵌入缓存：重新处理未变化的文档时不再调用Gemini
+        cached_embedder = CachedEmbeddings(embedder, model_id=embedder.model, dimensions=768)
         vector_store = QdrantVectorStore(
             client=client,
             collection_name=COLLECTION_NAME,
-            embedding=GeminiEmbedder()
+            embedding=cached_embedder
         )
 
         # 添加文档
         with st.spinner('📤 正在上传文档到Qdrant...'):
-            vector_store.add_documents(texts)
-            st.success("✅ 文档存储成功！")
+            # 每次交给嵌入器多个批次的文本块，让并发请求充分发挥作用
+            vector_store.add_documents(texts, batch_size=EMBED_BATCH_SIZE * EMBED_CONCURRENCY)
+            cache_stats = cached_embedder.stats()
+            st.success(f"✅ 文档存储成功！嵌入缓存命中{cache_stats['hits']}个，未命中{cache_stats['misses']}个")
             return vector_store
 
     except Exception as e:
@@ -334,7 +381,7 @@ if st.session_state.google_api_key:
                 texts = process_pdf(uploaded_file)
                 if texts and qdrant_client:
                     if st.session_state.vector_store:
-                        st.session_state.vector_store.add_documents(texts)
+                        st.session_state.vector_store.add_documents(texts, batch_size=EMBED_BATCH_SIZE * EMBED_CONCURRENCY)
                     else:
                         st.session_state.vector_store = create_vector_store(qdrant_client, texts)
                     st.session_state.processed_documents.append(file_name)
@@ -346,7 +393,7 @@ if st.session_state.google_api_key:
                 texts = process_web(web_url)
                 if texts and qdrant_client:
                     if st.session_state.vector_store:
-                        st.session_state.vector_store.add_documents(texts)
+                        st.session_state.vector_store.add_documents(texts, batch_size=EMBED_BATCH_SIZE * EMBED_CONCURRENCY)
                     else:
                         st.session_state.vector_store = create_vector_store(qdrant_client, texts)
                     st.session_state.processed_documents.append(web_url)
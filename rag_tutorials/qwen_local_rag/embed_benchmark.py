@@ -0,0 +1,54 @@
+"""对比逐块串行嵌入与批量并发嵌入的吞吐量（块/秒）
+
+用法:
+    python embed_benchmark.py --pdf 文档.pdf
+    python embed_benchmark.py --chunks 256 --batch-size 32 --concurrency 4
+
+需要本地运行Ollama并已拉取嵌入模型（ollama pull snowflake-arctic-embed）。
+"""
+import argparse
+import time
+from typing import List
+
+from ollama_embedder import OllamaEmbedderr, EMBED_BATCH_SIZE, EMBED_CONCURRENCY
+
+
+def load_chunks(pdf_path: str | None, num_chunks: int) -> List[str]:
+    if pdf_path:
+        from langchain_community.document_loaders import PyPDFLoader
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        # 与代理入库时相同的分块参数
+        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+        return [doc.page_content for doc in splitter.split_documents(PyPDFLoader(pdf_path).load())]
+    # 没有PDF时生成互不相同、长度接近真实分块的合成文本
+    return [f"第{i}段：" + "检索增强生成把文档切成文本块并为每块计算嵌入向量。" * 30 for i in range(num_chunks)]
+
+
+def measure(embedder: OllamaEmbedderr, chunks: List[str]) -> float:
+    start = time.perf_counter()
+    embedder.embed_documents(chunks)
+    return len(chunks) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ollama嵌入吞吐量对比：逐块串行 vs 批量并发")
+    parser.add_argument("--pdf", default=None, help="用该PDF的文本块做测试（默认使用合成文本）")
+    parser.add_argument("--chunks", type=int, default=256, help="合成文本块数")
+    parser.add_argument("--model", default="snowflake-arctic-embed")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=EMBED_CONCURRENCY)
+    args = parser.parse_args()
+
+    chunks = load_chunks(args.pdf, args.chunks)
+    # 先请求一次，把模型加载进内存，避免首个测试承担加载时间
+    OllamaEmbedderr(args.model).embed_query("warm up")
+
+    # batch_size=1、concurrency=1即原先的逐块循环：每个文本块一次请求
+    serial = measure(OllamaEmbedderr(args.model, batch_size=1, concurrency=1), chunks)
+    batched = measure(OllamaEmbedderr(args.model, batch_size=args.batch_size, concurrency=args.concurrency), chunks)
+
+    print(f"{len(chunks)}个文本块，模型{args.model}")
+    print(f"逐块串行:                        {serial:8.1f} 块/秒")
+    print(f"批量并发(批大小{args.batch_size}, 并发{args.concurrency}): {batched:8.1f} 块/秒")
+    print(f"加速比: {batched / serial:.2f}x")
@@ -0,0 +1,125 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", os.path.join("cache", "embeddings.sqlite"))
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "200000"))
+SQLITE_MAX_PARAMS = 500  # 单条IN查询的参数个数上限
+
+
+class CachedEmbeddings(Embeddings):
+    """按内容寻址的持久化嵌入缓存，包装任意LangChain Embeddings实现
+
+    缓存键为(模型ID, 维度, 文本的sha256)，向量以float32存入SQLite。
+    条目数超过上限时按最近访问时间淘汰；重新处理未变化的文档不会再调用嵌入模型。
+    只缓存文档嵌入；查询直接交给底层模型的embed_query（部分模型对查询和文档使用不同的嵌入方式）。
+
+    为保持各教程目录可独立运行，qwen_local_rag、deepseek_local_rag_agent和gemini_agentic_rag
+    中各有一份内容完全相同的副本，修改时请同步三处。
+    """
+
+    def __init__(self, embedder: Embeddings, model_id: str, dimensions: Optional[int] = None,
+                 path: str = EMBED_CACHE_PATH, max_entries: int = EMBED_CACHE_MAX_ENTRIES):
+        self.embedder = embedder
+        self.model_id = model_id
+        self.dimensions = dimensions
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, dimensions INTEGER, "
+            "vector BLOB NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_accessed ON embeddings(accessed_at)")
+        self._conn.commit()
+
+    def _key(self, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{self.model_id}\0{self.dimensions}\0{text_hash}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), SQLITE_MAX_PARAMS):
+                chunk = keys[i:i + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update({key: np.frombuffer(vector, dtype=np.float32).tolist() for key, vector in rows})
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+        return found
+
+    def _store(self, items: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dimensions, vector, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                [(key, self.model_id, self.dimensions, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                 for key, vector in items.items()],
+            )
+            # 超出容量时淘汰最久未访问的条目
+            cursor = self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.evictions += max(cursor.rowcount, 0)
+            self._conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self._lookup(list(dict.fromkeys(keys)))
+
+        # 只把未命中的文本（去重后）交给底层模型
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        miss_count = sum(1 for key in keys if key in missing)
+        self.hits += len(keys) - miss_count
+        self.misses += miss_count
+
+        if missing:
+            vectors = self.embedder.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self._store(computed)
+            cached.update(computed)
+        return [list(cached[key]) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        # 不经过文档缓存：查询向量可能与文档向量不同，一次性的查询也不应挤占文档条目
+        return self.embedder.embed_query(text)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
@@ -0,0 +1,55 @@
+import os
+import time
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+
+import ollama
+from langchain_core.embeddings import Embeddings
+
+# 嵌入批处理参数（设为1/1即退化为逐块串行请求，可用于对比吞吐量）
+EMBED_BATCH_SIZE = int(os.getenv("OLLAMA_EMBED_BATCH_SIZE", "32"))  # 每次请求嵌入的文本块数
+EMBED_CONCURRENCY = int(os.getenv("OLLAMA_EMBED_CONCURRENCY", "4"))  # 同时发送的嵌入请求数
+
+
+class OllamaEmbedderr(Embeddings):
+    def __init__(self, model_name="snowflake-arctic-embed", batch_size: int = EMBED_BATCH_SIZE,
+                 concurrency: int = EMBED_CONCURRENCY):
+        """
+        使用特定模型初始化OllamaEmbedderr。
+
+        参数:
+            model_name (str): 用于嵌入的模型名称。（snowflake-arctic-embed输出1024维向量）
+            batch_size (int): 每次请求嵌入的文本块数。
+            concurrency (int): 同时发送的嵌入请求数。
+        """
+        self.model_name = model_name
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        # 一个客户端复用keep-alive连接池，供所有线程共享（地址取自OLLAMA_HOST环境变量）
+        self.client = ollama.Client()
+        self.embedded_chunks = 0  # 累计嵌入的文本块数
+        self.embed_seconds = 0.0  # 累计嵌入耗时
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # /api/embed一次请求接受多条输入，按输入顺序返回向量
+        return [list(embedding) for embedding in self.client.embed(model=self.model_name, input=texts).embeddings]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) <= 1 or self.concurrency == 1:
+            embeddings = [embedding for batch in batches for embedding in self._embed_batch(batch)]
+        else:
+            # pool.map按提交顺序返回结果，输出与输入顺序一致
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as pool:
+                embeddings = [embedding for result in pool.map(self._embed_batch, batches) for embedding in result]
+        self.embedded_chunks += len(texts)
+        self.embed_seconds += time.perf_counter() - start
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0]
+
+    def throughput(self) -> float:
+        """累计嵌入吞吐量（块/秒）"""
+        return self.embedded_chunks / self.embed_seconds if self.embed_seconds else 0.0
@@ -11,26 +11,9 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_qdrant import QdrantVectorStore
 from qdrant_client import QdrantClient
 from qdrant_client.models import Distance, VectorParams
-from langchain_core.embeddings import Embeddings
 from agno.tools.exa import ExaTools
-from agno.embedder.ollama import OllamaEmbedder
-
-
-class OllamaEmbedderr(Embeddings):
-    def __init__(self, model_name="snowflake-arctic-embed"):
-        """
-        使用特定模型初始化OllamaEmbedderr。
-
-        参数:
-            model_name (str): 用于生成嵌入向量的模型名称。
-        """
-        self.embedder = OllamaEmbedder(id=model_name, dimensions=1024)
-
-    def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return [self.embed_query(text) for text in texts]
-
-    def embed_query(self, text: str) -> List[float]:
-        return self.embedder.get_embedding(text)
+from embedding_cache import CachedEmbeddings
+from ollama_embedder import OllamaEmbedderr, EMBED_BATCH_SIZE, EMBED_CONCURRENCY
 
 
 # 常量定义
@@ -221,16 +204,23 @@ def create_vector_store(client, texts):
                 raise e
 
         # 初始化向量存储
+        embedder = OllamaEmbedderr()
+        # 按内容寻址的嵌入缓存：重新处理未变化的文档时不再调用Ollama
+        cached_embedder = CachedEmbeddings(embedder, model_id=f"ollama/{embedder.model_name}", dimensions=1024)
         vector_store = QdrantVectorStore(
             client=client,
             collection_name=COLLECTION_NAME,
-            embedding=OllamaEmbedderr()
+            embedding=cached_embedder
         )
 
         # 添加文档
         with st.spinner('📤 正在将文档上传到Qdrant...'):
-            vector_store.add_documents(texts)
-            st.success("✅ 文档存储成功！")
+            # 每次交给嵌入器更多文本块，让批处理和并发请求充分发挥作用
+            vector_store.add_documents(texts, batch_size=EMBED_BATCH_SIZE * EMBED_CONCURRENCY)
+            cache_stats = cached_embedder.stats()
+            st.success(f"✅ 文档存储成功！嵌入{embedder.embedded_chunks}个文本块，"
+                       f"耗时{embedder.embed_seconds:.1f}秒（{embedder.throughput():.1f}块/秒）；"
+                       f"嵌入缓存命中{cache_stats['hits']}个，未命中{cache_stats['misses']}个")
             return vector_store
 
     except Exception as e:
@@ -0,0 +1,170 @@
+import os
+import io
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+# 持久化嵌入存储的默认目录（可通过环境变量覆盖）
+STORE_DIR = os.getenv("VISION_RAG_STORE_DIR", "vision_store")
+
+
+def file_sha256(path: str) -> str:
+    """计算文件内容的sha256哈希"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _npy_header(shape: tuple[int, int]) -> bytes:
+    """生成float32 C顺序矩阵的.npy文件头"""
+    buf = io.BytesIO()
+    np.lib.format.write_array_header_1_0(buf, {"descr": "<f4", "fortran_order": False, "shape": shape})
+    return buf.getvalue()
+
+
+class EmbeddingStore:
+    """磁盘上的嵌入存储：float32 .npy矩阵（内存映射读取）+ 图像路径与内容哈希清单
+
+    新嵌入以追加方式写入文件末尾，只更新文件头中的行数，不会重写已有数据。
+    同一进程内的所有会话共享一个实例，重启后直接从磁盘加载，无需重新计算嵌入。
+    """
+
+    def __init__(self, root: str = STORE_DIR):
+        self.root = root
+        self.matrix_path = os.path.join(root, "embeddings.npy")
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+        self.paths: list[str] = []  # 第i行嵌入对应的图像路径
+        self.hashes: list[str] = []  # 第i行嵌入对应的图像内容哈希
+        self._row_of_path: dict[str, int] = {}
+        self._row_of_hash: dict[str, int] = {}  # 内容哈希 -> 行号，相同内容只保存（和嵌入）一次
+        self._matrix = None
+        self._load()
+
+    # --- 加载 ---
+    def _load(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.paths = manifest.get("paths", [])
+            self.hashes = manifest.get("hashes", [])
+
+        if os.path.exists(self.matrix_path):
+            self._matrix = np.load(self.matrix_path, mmap_mode="r")
+            # 追加过程中被中断时，矩阵行数和清单条目可能不一致，以两者较小者为准
+            rows = min(self._matrix.shape[0], len(self.paths))
+            if rows != self._matrix.shape[0]:
+                self._rewrite(np.array(self._matrix[:rows]))
+            self.paths, self.hashes = self.paths[:rows], self.hashes[:rows]
+        else:
+            self.paths, self.hashes = [], []
+
+        self._row_of_path = {path: i for i, path in enumerate(self.paths)}
+        self._row_of_hash = {}
+        for i, content_hash in enumerate(self.hashes):
+            self._row_of_hash.setdefault(content_hash, i)
+
+    def _open(self):
+        self._matrix = np.load(self.matrix_path, mmap_mode="r")
+
+    def _rewrite(self, matrix: np.ndarray):
+        """整体重写矩阵文件（仅在首次写入或文件头无法原地扩展时使用）"""
+        tmp_path = os.path.join(self.root, "embeddings.tmp.npy")
+        np.save(tmp_path, np.ascontiguousarray(matrix, dtype=np.float32))
+        os.replace(tmp_path, self.matrix_path)
+        self._open()
+
+    def _save_manifest(self):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"paths": self.paths, "hashes": self.hashes}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    # --- 查询 ---
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @property
+    def embeddings(self) -> np.ndarray | None:
+        """所有嵌入（只读内存映射，shape为(n, dim)）"""
+        return self._matrix if self.paths else None
+
+    def has_path(self, path: str) -> bool:
+        return path in self._row_of_path
+
+    def has_hash(self, content_hash: str) -> bool:
+        return content_hash in self._row_of_hash
+
+    def lookup(self, path: str, content_hash: str | None = None) -> np.ndarray | None:
+        """返回已存储的嵌入；若给出内容哈希且与存储时不一致（文件已变化），返回None"""
+        row = self._row_of_path.get(path)
+        if row is None or (content_hash is not None and self.hashes[row] != content_hash):
+            return None
+        return np.asarray(self._matrix[row])
+
+    # --- 写入 ---
+    def add(self, paths: list[str], embeddings, hashes: list[str] | None = None) -> int:
+        """追加新嵌入，路径或内容哈希已存在的条目会被跳过；返回实际新增的行数"""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(paths), -1)
+        if hashes is None:
+            hashes = [file_sha256(path) for path in paths]
+
+        with self._lock:
+            keep, seen_paths, seen_hashes = [], set(), set()
+            for i, path in enumerate(paths):
+                if path in self._row_of_path or path in seen_paths:
+                    continue
+                if hashes[i] in self._row_of_hash or hashes[i] in seen_hashes:
+                    continue
+                keep.append(i)
+                seen_paths.add(path)
+                seen_hashes.add(hashes[i])
+            if not keep:
+                return 0
+            new_rows = np.ascontiguousarray(embeddings[keep])
+
+            if self._matrix is None or not self.paths:
+                self._rewrite(new_rows)
+            else:
+                if new_rows.shape[1] != self._matrix.shape[1]:
+                    raise ValueError(f"嵌入维度({new_rows.shape[1]})与存储维度({self._matrix.shape[1]})不一致")
+                self._append(new_rows)
+
+            for i in keep:
+                self._row_of_path[paths[i]] = len(self.paths)
+                self._row_of_hash[hashes[i]] = len(self.paths)
+                self.paths.append(paths[i])
+                self.hashes.append(hashes[i])
+            self._save_manifest()
+            return len(keep)
+
+    def _append(self, new_rows: np.ndarray):
+        """在文件末尾追加数据行，再原地更新文件头中的行数"""
+        old_rows, dim = self._matrix.shape
+        self._matrix = None  # 释放内存映射后再写文件
+        with open(self.matrix_path, "r+b") as f:
+            np.lib.format.read_magic(f)
+            np.lib.format.read_array_header_1_0(f)
+            header_len = f.tell()
+            new_header = _npy_header((old_rows + new_rows.shape[0], dim))
+            if len(new_header) != header_len:
+                # 文件头长度变化（行数位数超出预留空间）时退回到整体重写
+                f.seek(header_len)
+                old = np.frombuffer(f.read(old_rows * dim * 4), dtype=np.float32).reshape(old_rows, dim)
+                matrix = np.vstack((old, new_rows))
+            else:
+                f.seek(header_len + old_rows * dim * 4)
+                f.write(new_rows.tobytes())
+                f.seek(0)
+                f.write(new_header)
+                matrix = None
+        if matrix is not None:
+            self._rewrite(matrix)
+        else:
+            self._open()
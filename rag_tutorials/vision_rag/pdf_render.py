@@ -0,0 +1,69 @@
+import os
+import base64
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz  # PyMuPDF
+
+RENDER_DPI = 150  # 调整DPI平衡质量和性能
+MAX_PIXELS = 1568 * 1568  # 与嵌入模型的最大分辨率限制一致
+RENDER_WORKERS = int(os.getenv("VISION_RAG_RENDER_WORKERS", str(os.cpu_count() or 1)))
+MIN_PAGES_FOR_POOL = 8  # 页数较少时进程池的启动开销得不偿失，直接在当前进程渲染
+
+# 每个工作进程只打开一次PDF
+_worker_doc = None
+
+
+def _init_worker(pdf_bytes: bytes):
+    global _worker_doc
+    _worker_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+
+def _render_in_worker(page_index: int, dpi: int, max_pixels: int) -> tuple[int, bytes]:
+    return page_index, render_page_png(_worker_doc, page_index, dpi, max_pixels)
+
+
+def render_page_png(doc, page_index: int, dpi: int = RENDER_DPI, max_pixels: int = MAX_PIXELS) -> bytes:
+    """把一页渲染为PNG字节，只编码一次
+
+    超过像素上限的页面直接以更低的DPI渲染，而不是先渲染再缩放，
+    因此返回的字节既可以写入磁盘，也可以直接作为base64载荷发送给API。
+    """
+    page = doc[page_index]
+    width, height = page.rect.width * dpi / 72, page.rect.height * dpi / 72
+    if width * height > max_pixels:
+        dpi = int(dpi * (max_pixels / (width * height)) ** 0.5)
+    return page.get_pixmap(dpi=dpi).tobytes("png")
+
+
+def png_data_uri(png_bytes: bytes) -> str:
+    """PNG字节 -> 嵌入API使用的base64 data URI"""
+    return "data:image/png;base64," + base64.b64encode(png_bytes).decode("utf-8")
+
+
+def render_pdf_pages(pdf_bytes: bytes, num_pages: int, dpi: int = RENDER_DPI, max_pixels: int = MAX_PIXELS,
+                     workers: int = RENDER_WORKERS):
+    """按页码顺序逐页产出(page_index, png_bytes)，大文件在进程池中并行渲染
+
+    同时提交的渲染任务不超过workers的两倍，消费方处理不过来时渲染也会随之暂停。
+    """
+    if workers <= 1 or num_pages < MIN_PAGES_FOR_POOL:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            for i in range(num_pages):
+                yield i, render_page_png(doc, i, dpi, max_pixels)
+        finally:
+            doc.close()
+        return
+
+    # 使用spawn而不是fork：Streamlit服务进程是多线程的，fork出的子进程可能继承被占用的锁
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(pdf_bytes,)) as pool:
+        pending = deque()
+        next_page = 0
+        while next_page < num_pages or pending:
+            while next_page < num_pages and len(pending) < workers * 2:
+                pending.append(pool.submit(_render_in_worker, next_page, dpi, max_pixels))
+                next_page += 1
+            yield pending.popleft().result()
@@ -0,0 +1,104 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+QUERY_CACHE_PATH = os.getenv("VISION_RAG_QUERY_CACHE_PATH", os.path.join("vision_store", "query_cache.sqlite"))
+QUERY_CACHE_MEMORY_ENTRIES = 256  # 内存LRU的容量
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("VISION_RAG_QUERY_CACHE_MAX_ENTRIES", "10000"))  # 磁盘缓存的容量
+
+
+def normalize_query(text: str) -> str:
+    """小写并合并空白，使仅在大小写或空格上不同的问题命中同一条缓存"""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """查询嵌入的两级缓存：进程内LRU + SQLite磁盘缓存，键为(模型, 规范化后的问题文本)"""
+
+    def __init__(self, path: str = QUERY_CACHE_PATH, memory_entries: int = QUERY_CACHE_MEMORY_ENTRIES,
+                 max_entries: int = QUERY_CACHE_MAX_ENTRIES):
+        self.memory_entries = memory_entries
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS query_embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, query TEXT NOT NULL, "
+            "vector BLOB NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_query_accessed ON query_embeddings(accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def _key(model: str, query: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_query(query)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, model: str, query: str) -> np.ndarray | None:
+        key = self._key(model, query)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+
+            row = self._conn.execute("SELECT vector FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE query_embeddings SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector
+
+    def put(self, model: str, query: str, vector: np.ndarray) -> None:
+        key = self._key(model, query)
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, model, query, vector, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model, normalize_query(query), vector.tobytes(), time.time()),
+            )
+            # 超出容量时淘汰最久未访问的条目
+            self._conn.execute(
+                "DELETE FROM query_embeddings WHERE key IN (SELECT key FROM query_embeddings "
+                "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
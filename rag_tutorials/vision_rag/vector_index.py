@@ -0,0 +1,289 @@
+import os
+import threading
+
+import numpy as np
+
+# 向量数量达到该阈值后，从精确的暴力搜索切换为近似的IVF倒排索引
+ANN_THRESHOLD = int(os.getenv("VISION_RAG_ANN_THRESHOLD", "20000"))
+IVF_NPROBE = int(os.getenv("VISION_RAG_IVF_NPROBE", "8"))  # 每次查询探查的聚类数
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64  # 训练聚类中心时每个聚类使用的样本数
+RETRAIN_GROWTH = 4  # 向量数增长到训练时的若干倍后重新训练，避免倒排列表严重失衡
+ASSIGN_CHUNK_ROWS = 8192  # 分块计算聚类分配，控制内存占用
+QUANTIZATION = os.getenv("VISION_RAG_QUANTIZATION", "int8")  # 内存中打分矩阵的存储类型："float32" 或 "int8"
+RESCORE_FACTOR = 4  # int8打分先取k*RESCORE_FACTOR个候选，再用全精度向量重新打分
+GROWTH_FACTOR = 1.5  # 矩阵容量不足时按该倍数扩容，追加的摊销成本为O(1)
+INITIAL_CAPACITY = 1024
+SCORE_CHUNK_ROWS = 65536  # int8矩阵分块打分，避免一次性转换整个矩阵
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """返回得分最高的k个下标（降序），用argpartition避免对全部得分排序"""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx])]
+
+
+class CompactMatrix:
+    """内存中的紧凑嵌入矩阵：float32存储，或按行对称的int8标量量化（每行一个缩放系数）
+
+    预分配容量并按GROWTH_FACTOR倍扩容，追加新行不需要每次重新分配和复制整个矩阵。
+    """
+
+    def __init__(self, quantization: str = QUANTIZATION):
+        if quantization not in ("float32", "int8"):
+            raise ValueError(f"不支持的量化类型: {quantization}")
+        self.quantization = quantization
+        self._data = None  # (capacity, dim)，float32或int8
+        self._scales = None  # int8时每行的缩放系数，(capacity,)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def dim(self) -> int | None:
+        return None if self._data is None else self._data.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        """已使用行占用的字节数"""
+        if self._data is None:
+            return 0
+        row_bytes = self._data.shape[1] * self._data.itemsize + (4 if self._scales is not None else 0)
+        return self._size * row_bytes
+
+    def _reserve(self, rows: int, dim: int):
+        capacity = 0 if self._data is None else self._data.shape[0]
+        if self._size + rows <= capacity:
+            return
+        new_capacity = max(self._size + rows, int(capacity * GROWTH_FACTOR), INITIAL_CAPACITY)
+        data = np.empty((new_capacity, dim), dtype=np.int8 if self.quantization == "int8" else np.float32)
+        if self._data is not None:
+            data[:self._size] = self._data[:self._size]
+        self._data = data
+        if self.quantization == "int8":
+            scales = np.empty(new_capacity, dtype=np.float32)
+            if self._scales is not None:
+                scales[:self._size] = self._scales[:self._size]
+            self._scales = scales
+
+    def append(self, rows: np.ndarray) -> None:
+        rows = np.asarray(rows, dtype=np.float32)
+        n = rows.shape[0]
+        if n == 0:
+            return
+        self._reserve(n, rows.shape[1])
+        end = self._size + n
+        if self.quantization == "int8":
+            scales = np.abs(rows).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            self._data[self._size:end] = np.rint(rows / scales[:, None]).astype(np.int8)
+            self._scales[self._size:end] = scales
+        else:
+            self._data[self._size:end] = rows
+        self._size = end
+
+    def scores(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """查询与全部行（或指定行）的点积；int8时为近似值"""
+        if self.quantization == "float32":
+            return (self._data[:self._size] if rows is None else self._data[rows]) @ query
+        if rows is not None:
+            return (self._data[rows] @ query) * self._scales[rows]
+        out = np.empty(self._size, dtype=np.float32)
+        for start in range(0, self._size, SCORE_CHUNK_ROWS):
+            end = min(start + SCORE_CHUNK_ROWS, self._size)
+            out[start:end] = (self._data[start:end] @ query) * self._scales[start:end]
+        return out
+
+
+def rescore(vectors: np.ndarray, rows: np.ndarray, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """用全精度向量对候选行重新打分，返回top-k"""
+    rows = np.sort(rows)  # 按行号顺序读取内存映射，减少随机访问
+    scores = np.asarray(vectors[rows], dtype=np.float32) @ query
+    best = top_k(scores, k)
+    return rows[best], scores[best]
+
+
+class FlatIndex:
+    """精确搜索：对全部向量计算点积，再用argpartition取top-k
+
+    提供紧凑矩阵时在其上打分；int8量化得分先取k*RESCORE_FACTOR个候选，再用全精度向量重新打分。
+    """
+
+    kind = "flat"
+
+    def __init__(self, matrix: CompactMatrix | None = None):
+        self.vectors = None
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return 0 if self.vectors is None else self.vectors.shape[0]
+
+    def sync(self, vectors: np.ndarray) -> None:
+        # 全精度向量由嵌入存储持有，这里只保存引用，无需额外维护
+        self.vectors = vectors
+
+    def search(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.matrix is None:
+            scores = self.vectors @ query
+            rows = top_k(scores, k)
+            return rows, scores[rows]
+        scores = self.matrix.scores(query)
+        if self.matrix.quantization == "float32":
+            rows = top_k(scores, k)
+            return rows, scores[rows]
+        return rescore(self.vectors, top_k(scores, k * RESCORE_FACTOR), query, k)
+
+
+class IVFIndex:
+    """近似搜索：球面k-means把向量划分到若干倒排列表，查询时只精确计算最近nprobe个列表中的向量
+
+    聚类中心和每行向量所属的列表保存在磁盘上；新增向量只需分配到最近的列表，
+    向量数量比训练时增长RETRAIN_GROWTH倍后才重新训练。
+    """
+
+    kind = "ivf"
+
+    def __init__(self, path: str | None = None, nprobe: int = IVF_NPROBE, matrix: CompactMatrix | None = None):
+        self.path = path
+        self.nprobe = nprobe
+        self.vectors = None
+        self.matrix = matrix
+        self.centroids = None  # (nlist, dim)
+        self.assignments = np.empty(0, dtype=np.int32)  # 第i行向量所属的列表
+        self.trained_size = 0
+        self.lists: list[np.ndarray] = []
+        if path and os.path.exists(path):
+            self._load()
+
+    def __len__(self) -> int:
+        return self.assignments.shape[0]
+
+    # --- 持久化 ---
+    def _load(self):
+        data = np.load(self.path)
+        self.centroids = data["centroids"]
+        self.assignments = data["assignments"]
+        self.trained_size = int(data["trained_size"])
+        self._rebuild_lists()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, assignments=self.assignments, trained_size=self.trained_size)
+        os.replace(tmp_path, self.path)
+
+    # --- 训练与分配 ---
+    def _rebuild_lists(self):
+        order = np.argsort(self.assignments, kind="stable")
+        counts = np.bincount(self.assignments, minlength=self.centroids.shape[0])
+        self.lists = np.split(order, np.cumsum(counts)[:-1])
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        labels = [np.argmax(vectors[i:i + ASSIGN_CHUNK_ROWS] @ self.centroids.T, axis=1)
+                  for i in range(0, vectors.shape[0], ASSIGN_CHUNK_ROWS)]
+        return np.concatenate(labels).astype(np.int32) if labels else np.empty(0, dtype=np.int32)
+
+    def train(self, vectors: np.ndarray, seed: int = 0) -> None:
+        n = vectors.shape[0]
+        nlist = max(1, int(4 * np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample_size = min(n, nlist * KMEANS_SAMPLES_PER_LIST)
+        nlist = min(nlist, sample_size)  # 向量很少时（如n<16）聚类数不能超过样本数
+        sample = np.asarray(vectors[np.sort(rng.choice(n, sample_size, replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]  # 空聚类保留原中心
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        self.centroids = centroids
+        self.trained_size = n
+        self.assignments = self._assign(vectors)
+        self._rebuild_lists()
+
+    def sync(self, vectors: np.ndarray) -> None:
+        """把矩阵中尚未索引的新行加入索引（矩阵只会追加，不会修改已有行）"""
+        self.vectors = vectors
+        n = vectors.shape[0]
+        if self.centroids is None or n < len(self) or n >= RETRAIN_GROWTH * max(self.trained_size, 1) \
+                or self.centroids.shape[1] != vectors.shape[1]:
+            self.train(vectors)
+        elif n > len(self):
+            start = len(self)
+            new_labels = self._assign(vectors[start:])
+            self.assignments = np.concatenate((self.assignments, new_labels))
+            for label in np.unique(new_labels):
+                rows = start + np.flatnonzero(new_labels == label)
+                self.lists[label] = np.concatenate((self.lists[label], rows))
+        else:
+            return
+        self._save()
+
+    def search(self, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if not len(self):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        probes = top_k(self.centroids @ query, self.nprobe)
+        candidates = np.sort(np.concatenate([self.lists[label] for label in probes]))
+        if self.matrix is not None and self.matrix.quantization == "int8":
+            approx = self.matrix.scores(query, candidates)
+            return rescore(self.vectors, candidates[top_k(approx, k * RESCORE_FACTOR)], query, k)
+        if self.matrix is not None:
+            scores = self.matrix.scores(query, candidates)
+        else:
+            scores = np.asarray(self.vectors[candidates]) @ query
+        best = top_k(scores, k)
+        return candidates[best], scores[best]
+
+
+class VectorIndex:
+    """可插拔的top-k索引：向量数低于阈值时用精确搜索，超过阈值后自动切换到IVF近似搜索
+
+    两种索引共用一个内存中的紧凑矩阵打分，全精度向量只在重新打分时从内存映射中按行读取。
+    """
+
+    def __init__(self, root: str, ann_threshold: int = ANN_THRESHOLD, nprobe: int = IVF_NPROBE,
+                 quantization: str = QUANTIZATION):
+        self.ann_threshold = ann_threshold
+        self.matrix = CompactMatrix(quantization)
+        self._flat = FlatIndex(self.matrix)
+        self._ivf = IVFIndex(os.path.join(root, "ivf_index.npz"), nprobe=nprobe, matrix=self.matrix)
+        self._active = self._flat
+        self._lock = threading.Lock()
+
+    @property
+    def kind(self) -> str:
+        return self._active.kind
+
+    def sync(self, vectors: np.ndarray | None) -> None:
+        if vectors is None:
+            return
+        with self._lock:
+            n = vectors.shape[0]
+            if n < len(self.matrix) or self.matrix.dim not in (None, vectors.shape[1]):
+                # 存储被截断或维度变化时重建紧凑矩阵
+                self.matrix = CompactMatrix(self.matrix.quantization)
+                self._flat.matrix = self._ivf.matrix = self.matrix
+            if n > len(self.matrix):
+                self.matrix.append(vectors[len(self.matrix):])
+            self._active = self._ivf if n >= self.ann_threshold else self._flat
+            self._active.sync(vectors)
+
+    def memory_report(self) -> str:
+        """紧凑矩阵的内存占用，以及同样数据用float64存储时的大小"""
+        n, dim = len(self.matrix), self.matrix.dim or 0
+        return (f"{self.matrix.quantization} {self.matrix.nbytes / 2 ** 20:.1f}MB"
+                f"（float64需{n * dim * 8 / 2 ** 20:.1f}MB）")
+
+    def search(self, query: np.ndarray, k: int = 1) -> tuple[np.ndarray, np.ndarray]:
+        """返回(行号数组, 得分数组)，按得分降序"""
+        with self._lock:
+            return self._active.search(np.asarray(query, dtype=np.float32), k)
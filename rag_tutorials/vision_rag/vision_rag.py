@@ -1,15 +1,30 @@
 import requests
 import os
 import io
+import time
+import queue
 import base64
-import PIL
-from PIL import Image
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import PIL.Image
 import tqdm
 import numpy as np
 import streamlit as st
 import cohere
 from google import genai
 import fitz  # PyMuPDF，用于处理PDF文件
+from embedding_store import EmbeddingStore, file_sha256
+from vector_index import VectorIndex, FlatIndex
+from query_cache import QueryEmbeddingCache
+from pdf_render import render_pdf_pages, png_data_uri, RENDER_DPI, RENDER_WORKERS
+
+# PDF页面嵌入流水线的默认参数
+EMBED_BATCH_SIZE = int(os.getenv("VISION_RAG_EMBED_BATCH_SIZE", "8"))  # 每次嵌入请求包含的页面数
+EMBED_CONCURRENCY = int(os.getenv("VISION_RAG_EMBED_CONCURRENCY", "4"))  # 同时进行的嵌入请求数
+EMBED_RETRIES = 3  # 嵌入请求失败后的重试次数（指数退避）
+PAGE_QUEUE_SIZE = 32  # 渲染阶段最多领先嵌入阶段的页面数
+EMBED_MODEL = "embed-v4.0"
 
 # --- Streamlit应用配置 ---
 st.set_page_config(layout="wide", page_title="基于Cohere Embed-4的视觉RAG")
@@ -31,14 +46,54 @@ with st.sidebar:
         st.warning("请输入Google API密钥以继续")
     st.markdown("---")
 
+    st.header("⚙️ PDF处理设置")
+    embed_batch_size = st.number_input("每批嵌入页数", min_value=1, max_value=96, value=EMBED_BATCH_SIZE)
+    embed_concurrency = st.number_input("并发嵌入请求数", min_value=1, max_value=16, value=EMBED_CONCURRENCY)
+    st.markdown("---")
+
+    st.header("🔍 检索设置")
+    search_top_k_count = st.number_input("检索候选数（top-k）", min_value=1, max_value=20, value=3)
+    st.markdown("---")
+
+
+
+# 持久化嵌入存储：进程内所有会话共享，重启后从磁盘加载
+@st.cache_resource(show_spinner=False)
+def get_embedding_store() -> EmbeddingStore:
+    return EmbeddingStore()
+
+
+# top-k检索索引：与嵌入存储一样由所有会话共享，新增嵌入时增量更新
+@st.cache_resource(show_spinner=False)
+def get_vector_index() -> VectorIndex:
+    store = get_embedding_store()
+    index = VectorIndex(store.root)
+    index.sync(store.embeddings)
+    return index
+
+
+# 查询嵌入缓存：相同的问题（规范化后）不再请求Cohere
+@st.cache_resource(show_spinner=False)
+def get_query_cache() -> QueryEmbeddingCache:
+    return QueryEmbeddingCache()
+
+
+def sync_session_from_store(store: EmbeddingStore) -> None:
+    """用持久化存储中的内容刷新会话状态和检索索引"""
+    st.session_state.image_paths = list(store.paths)
+    st.session_state.doc_embeddings = store.embeddings
+    get_vector_index().sync(store.embeddings)
+
+
 # --- 初始化API客户端 ---
 co = None  # Cohere客户端实例
 genai_client = None  # Google Gemini客户端实例
-# 初始化会话状态用于存储嵌入和图像路径
-if 'image_paths' not in st.session_state:
-    st.session_state.image_paths = []  # 存储所有处理过的图像路径
-if 'doc_embeddings' not in st.session_state:
-    st.session_state.doc_embeddings = None  # 存储所有图像的嵌入向量
+embedding_store = get_embedding_store()
+# 初始化会话状态用于存储嵌入和图像路径（启动时载入已持久化的嵌入，其他会话新增的内容也会同步过来）
+if 'image_paths' not in st.session_state or len(st.session_state.image_paths) != len(embedding_store):
+    sync_session_from_store(embedding_store)
+vector_index = get_vector_index()
+st.sidebar.caption(f"💾 已持久化{len(embedding_store)}个图像嵌入（{embedding_store.root}/，索引: {vector_index.kind}，{vector_index.memory_report()}）")
 
 # 当两个API密钥都提供时，初始化客户端
 if cohere_api_key and google_api_key:
@@ -112,24 +167,6 @@ def base64_from_image(img_path: str) -> str:
     return img_data
 
 
-# 将PIL图像转换为base64字符串
-def pil_to_base64(pil_image: PIL.Image.Image) -> str:
-    """将PIL图像对象转换为base64编码的字符串"""
-    if pil_image.format is None:
-        img_format = "PNG"  # 默认为PNG格式
-    else:
-        img_format = pil_image.format
-
-    resize_image(pil_image)  # 调整图像大小
-
-    with io.BytesIO() as img_buffer:
-        pil_image.save(img_buffer, format=img_format)
-        img_buffer.seek(0)
-        img_data = f"data:image/{img_format.lower()};base64," + base64.b64encode(img_buffer.read()).decode("utf-8")
-
-    return img_data
-
-
 # 计算图像的嵌入向量
 @st.cache_data(ttl=3600, show_spinner=False)
 def compute_image_embedding(base64_img: str, _cohere_client) -> np.ndarray | None:
@@ -144,7 +181,7 @@ def compute_image_embedding(base64_img: str, _cohere_client) -> np.ndarray | Non
 
         # 提取嵌入向量
         if api_response.embeddings and api_response.embeddings.float:
-            return np.asarray(api_response.embeddings.float[0])
+            return np.asarray(api_response.embeddings.float[0], dtype=np.float32)
         else:
             st.warning("无法获取嵌入向量，API响应可能为空")
             return None
@@ -153,76 +190,171 @@ def compute_image_embedding(base64_img: str, _cohere_client) -> np.ndarray | Non
         return None
 
 
+# 批量嵌入多张图像（在工作线程中运行，因此不调用任何st.*界面函数）
+def embed_images_batch(base64_imgs: list[str], cohere_client, retries: int = EMBED_RETRIES) -> list[np.ndarray | None]:
+    """一次请求嵌入多张图像，失败时指数退避重试，返回结果与输入顺序一致"""
+    # embed-v4.0的images参数每次只接受一张图像，多图批量需要通过inputs传入
+    inputs = [{"content": [{"type": "image_url", "image_url": {"url": img}}]} for img in base64_imgs]
+    for attempt in range(retries + 1):
+        try:
+            api_response = cohere_client.embed(
+                model=EMBED_MODEL,
+                input_type="search_document",
+                embedding_types=["float"],
+                inputs=inputs,
+            )
+            vectors = api_response.embeddings.float if api_response.embeddings else None
+            if vectors and len(vectors) == len(base64_imgs):
+                return [np.asarray(v, dtype=np.float32) for v in vectors]
+            print(f"批量嵌入响应为空或数量不符（第{attempt + 1}次尝试）")
+        except Exception as e:
+            print(f"批量嵌入失败（第{attempt + 1}次尝试）: {e}")
+        if attempt < retries:
+            time.sleep(2 ** attempt)
+    return [None] * len(base64_imgs)
+
+
 # 处理PDF文件：提取页面作为图像并生成嵌入
-def process_pdf_file(pdf_file, cohere_client, base_output_folder="pdf_pages") -> tuple[
-    list[str], list[np.ndarray] | None]:
+def process_pdf_file(pdf_file, cohere_client, base_output_folder="pdf_pages", store: EmbeddingStore | None = None,
+                     batch_size: int = EMBED_BATCH_SIZE, concurrency: int = EMBED_CONCURRENCY,
+                     render_workers: int = RENDER_WORKERS, seen_hashes: set[str] | None = None) -> tuple[
+    list[str], list[np.ndarray] | None, list[str], dict[str, int]]:
     """从PDF中提取页面作为图像，生成嵌入并保存
 
+    渲染和嵌入以流水线方式进行：后台线程从进程池按页码顺序取回渲染好的页面放入有界队列，
+    主线程把页面攒成批，以最多concurrency个并发请求发送给Cohere，同时更新进度条。
+    每页只编码一次PNG，同一份字节既写入磁盘，也作为base64载荷发送。
+
     参数:
         pdf_file: Streamlit的上传文件对象
         cohere_client: 初始化的Cohere客户端
         base_output_folder: 保存页面图像的目录
+        store: 持久化嵌入存储，内容哈希已在其中的页面会被跳过，不再重复嵌入
+        batch_size: 每次嵌入请求包含的页面数
+        concurrency: 同时进行的嵌入请求数
+        render_workers: 渲染页面的进程数
+        seen_hashes: 本次上传中已处理页面的内容哈希（跨文件共享，处理后会加入本PDF的页面）
 
     返回:
         包含以下内容的元组:
-          - 保存的页面图像路径列表
-          - 每个页面的numpy数组嵌入列表，若嵌入失败则为None
+          - 新页面的图像路径列表（按页码顺序）
+          - 新页面的numpy数组嵌入列表，若嵌入失败则为None
+          - 新页面图像的内容哈希列表（与路径一一对应）
+          - 跳过的页面数：{"existing": 已加载过的页面, "duplicate": 与其他页面内容相同的页面}
     """
-    page_image_paths = []  # 存储页面图像路径
-    page_embeddings = []  # 存储页面嵌入向量
     pdf_filename = pdf_file.name
-    # 创建输出目录（按PDF文件名分类）
-    output_folder = os.path.join(base_output_folder, os.path.splitext(pdf_filename)[0])
-    os.makedirs(output_folder, exist_ok=True)
+    skipped = {"existing": 0, "duplicate": 0}
+    seen_hashes = set() if seen_hashes is None else seen_hashes
 
     try:
-        # 从流中打开PDF
-        doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
-        st.write(f"处理PDF: {pdf_filename}（共{len(doc)}页）")
+        # 从流中读取PDF（渲染在子进程中进行，这里只需要页数）
+        pdf_bytes = pdf_file.read()
+        # 创建输出目录（按PDF文件名和文件内容哈希分类）：同名但内容不同的PDF不会覆盖彼此的页面图像
+        output_folder = os.path.join(base_output_folder, os.path.splitext(pdf_filename)[0],
+                                     hashlib.sha256(pdf_bytes).hexdigest()[:16])
+        os.makedirs(output_folder, exist_ok=True)
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            num_pages = len(doc)
+        st.write(f"处理PDF: {pdf_filename}（共{num_pages}页）")
         pdf_progress = st.progress(0.0)  # 显示处理进度
 
-        for i, page in enumerate(doc.pages()):
-            page_num = i + 1
-            page_img_path = os.path.join(output_folder, f"page_{page_num}.png")
-            page_image_paths.append(page_img_path)
+        page_image_paths = [os.path.join(output_folder, f"page_{i + 1}.png") for i in range(num_pages)]
+        page_embeddings = [None] * num_pages  # 按页码下标写入，保证与页面顺序对齐
+        page_hashes = [None] * num_pages  # 页面图像的内容哈希
+        skipped_pages = set()  # 因内容哈希已存在而跳过的页码下标
+        page_queue = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+        render_errors = []
 
-            # 将页面渲染为图像
-            pix = page.get_pixmap(dpi=150)  # 调整DPI平衡质量和性能
-            pil_image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-
-            # 临时保存页面图像
-            pil_image.save(page_img_path, "PNG")
-
-            # 将PIL图像转换为base64
-            base64_img = pil_to_base64(pil_image)
-
-            # 计算页面图像的嵌入
-            emb = compute_image_embedding(base64_img, _cohere_client=cohere_client)
-            if emb is not None:
-                page_embeddings.append(emb)
-            else:
-                st.warning(f"无法为{pdf_filename}的第{page_num}页生成嵌入，已跳过")
-                page_embeddings.append(None)  # 添加占位符保持列表对齐
-
-            # 更新进度条
-            pdf_progress.progress((i + 1) / len(doc))
-
-        doc.close()
+        def render_pages():
+            # 渲染阶段：队列满时阻塞，渲染最多领先嵌入PAGE_QUEUE_SIZE页
+            try:
+                for i, png_bytes in render_pdf_pages(pdf_bytes, num_pages, dpi=RENDER_DPI, max_pixels=max_pixels,
+                                                     workers=render_workers):
+                    with open(page_image_paths[i], "wb") as f:  # 保存页面图像
+                        f.write(png_bytes)
+                    page_queue.put((i, hashlib.sha256(png_bytes).hexdigest(), png_data_uri(png_bytes)))
+            except Exception as e:
+                render_errors.append(e)
+            finally:
+                page_queue.put(None)  # 结束标记
+
+        renderer = threading.Thread(target=render_pages, daemon=True)
+        renderer.start()
+
+        in_flight = {}  # 进行中的嵌入请求 -> 对应的页码下标
+        finished_pages = 0
+
+        def collect(futures):
+            nonlocal finished_pages
+            for future in futures:
+                indices = in_flight.pop(future)
+                for i, emb in zip(indices, future.result()):
+                    page_embeddings[i] = emb
+                finished_pages += len(indices)
+
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            batch = []
+            while True:
+                item = page_queue.get()
+                if item is not None:
+                    i, content_hash, base64_img = item
+                    page_hashes[i] = content_hash
+                    # 按内容哈希去重（O(1)）：已加载过或与其他页面内容相同的页面不再嵌入
+                    if store is not None and store.lookup(page_image_paths[i], content_hash) is not None:
+                        skipped["existing"] += 1
+                        skipped_pages.add(i)
+                    elif content_hash in seen_hashes or (store is not None and store.has_hash(content_hash)):
+                        skipped["duplicate"] += 1
+                        skipped_pages.add(i)
+                    else:
+                        seen_hashes.add(content_hash)
+                        batch.append((i, base64_img))
+                    if i in skipped_pages:
+                        finished_pages += 1
+
+                if batch and (item is None or len(batch) >= batch_size):
+                    # 在途请求达到上限时，先等待其中一个完成
+                    while len(in_flight) >= max(1, concurrency):
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    indices = [i for i, _ in batch]
+                    in_flight[pool.submit(embed_images_batch, [img for _, img in batch], cohere_client)] = indices
+                    batch = []
+
+                collect([future for future in in_flight if future.done()])
+                pdf_progress.progress(finished_pages / max(num_pages, 1))
+                if item is None:
+                    break
+
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+                pdf_progress.progress(finished_pages / max(num_pages, 1))
+
+        renderer.join()
         pdf_progress.empty()  # 完成后移除进度条
+        if render_errors:
+            raise render_errors[0]
+
+        for i, emb in enumerate(page_embeddings):
+            if emb is None and i not in skipped_pages:
+                st.warning(f"无法为{pdf_filename}的第{i + 1}页生成嵌入，已跳过")
 
-        # 过滤掉嵌入失败的页面
+        # 过滤掉嵌入失败和被去重跳过的页面
         valid_paths = [path for i, path in enumerate(page_image_paths) if page_embeddings[i] is not None]
         valid_embeddings = [emb for emb in page_embeddings if emb is not None]
+        valid_hashes = [page_hashes[i] for i, emb in enumerate(page_embeddings) if emb is not None]
 
         if not valid_embeddings:
-            st.error(f"无法为{pdf_filename}生成任何有效嵌入")
-            return [], None
+            if len(skipped_pages) < num_pages:
+                st.error(f"无法为{pdf_filename}生成任何有效嵌入")
+            return [], None, [], skipped
 
-        return valid_paths, valid_embeddings
+        return valid_paths, valid_embeddings, valid_hashes, skipped
 
     except Exception as e:
         st.error(f"处理PDF {pdf_filename}时出错: {e}")
-        return [], None
+        return [], None, [], skipped
 
 
 # 下载并嵌入样本图像
@@ -279,8 +411,11 @@ def download_and_embed_sample_images(_cohere_client) -> tuple[list[str], np.ndar
                 try:
                     # 确保文件存在后再计算嵌入
                     if os.path.exists(img_path):
-                        base64_img = base64_from_image(img_path)
-                        emb = compute_image_embedding(base64_img, _cohere_client=_cohere_client)
+                        # 优先复用磁盘上已持久化的嵌入
+                        emb = get_embedding_store().lookup(img_path, file_sha256(img_path))
+                        if emb is None:
+                            base64_img = base64_from_image(img_path)
+                            emb = compute_image_embedding(base64_img, _cohere_client=_cohere_client)
                         if emb is not None:
                             # 确保嵌入列表长度与路径列表一致
                             while len(doc_embeddings) < current_index:
@@ -310,50 +445,65 @@ def download_and_embed_sample_images(_cohere_client) -> tuple[list[str], np.ndar
 
 
 # 搜索函数
-def search(question: str, co_client: cohere.Client, embeddings: np.ndarray, image_paths: list[str],
-           max_img_size: int = 800) -> str | None:
-    """为给定问题找到最相关的图像路径"""
+def search_top_k(question: str, co_client: cohere.Client, embeddings: np.ndarray, image_paths: list[str],
+                 top_k: int = 1, index: VectorIndex | None = None,
+                 query_cache: QueryEmbeddingCache | None = None) -> list[tuple[str, float]]:
+    """为给定问题找到最相关的top_k个图像路径及其相似度（按相似度降序）"""
     # 检查必要条件是否满足
     if not co_client or embeddings is None or embeddings.size == 0 or not image_paths:
         st.warning("搜索前置条件不满足（客户端、嵌入或路径缺失/为空）")
-        return None
+        return []
     if embeddings.shape[0] != len(image_paths):
         st.error(f"嵌入数量({embeddings.shape[0]})与图像路径数量({len(image_paths)})不匹配，无法执行搜索")
-        return None
+        return []
 
     try:
-        # 计算查询的嵌入向量
-        api_response = co_client.embed(
-            model="embed-v4.0",
-            input_type="search_query",  # 表示这是查询嵌入
-            embedding_types=["float"],
-            texts=[question],  # 传入问题文本
-        )
-
-        if not api_response.embeddings or not api_response.embeddings.float:
-            st.error("无法获取查询嵌入")
-            return None
-
-        query_emb = np.asarray(api_response.embeddings.float[0])
+        # 优先使用缓存的查询嵌入，未命中时才请求Cohere
+        query_emb = query_cache.get(EMBED_MODEL, question) if query_cache is not None else None
+        if query_emb is None:
+            # 计算查询的嵌入向量
+            api_response = co_client.embed(
+                model=EMBED_MODEL,
+                input_type="search_query",  # 表示这是查询嵌入
+                embedding_types=["float"],
+                texts=[question],  # 传入问题文本
+            )
+
+            if not api_response.embeddings or not api_response.embeddings.float:
+                st.error("无法获取查询嵌入")
+                return []
+
+            query_emb = np.asarray(api_response.embeddings.float[0], dtype=np.float32)
+            if query_cache is not None:
+                query_cache.put(EMBED_MODEL, question, query_emb)
 
         # 确保查询嵌入维度与文档嵌入一致
         if query_emb.shape[0] != embeddings.shape[1]:
             st.error(f"查询嵌入维度({query_emb.shape[0]})与文档嵌入维度({embeddings.shape[1]})不匹配")
-            return None
-
-        # 计算余弦相似度（点积，因为嵌入已归一化）
-        cos_sim_scores = np.dot(query_emb, embeddings.T)
-
-        # 获取最相关的图像
-        top_idx = np.argmax(cos_sim_scores)
-        hit_img_path = image_paths[top_idx]
+            return []
+
+        # 余弦相似度即点积（嵌入已归一化）；未提供共享索引时对当前矩阵做精确搜索
+        if index is None:
+            index = FlatIndex()
+            index.sync(embeddings)
+        rows, scores = index.search(query_emb, top_k)
+        # 共享索引可能包含其他会话刚新增、本会话尚未同步的行
+        hits = [(image_paths[row], float(score)) for row, score in zip(rows, scores) if row < len(image_paths)]
         print(f"问题: {question}")  # 调试用
-        print(f"最相关图像: {hit_img_path}")  # 调试用
+        print(f"最相关图像: {hits}")  # 调试用
 
-        return hit_img_path
+        return hits
     except Exception as e:
         st.error(f"搜索过程中出错: {e}")
-        return None
+        return []
+
+
+def search(question: str, co_client: cohere.Client, embeddings: np.ndarray, image_paths: list[str],
+           max_img_size: int = 800, index: VectorIndex | None = None,
+           query_cache: QueryEmbeddingCache | None = None) -> str | None:
+    """为给定问题找到最相关的图像路径"""
+    hits = search_top_k(question, co_client, embeddings, image_paths, top_k=1, index=index, query_cache=query_cache)
+    return hits[0][0] if hits else None
 
 
 # 回答函数
@@ -396,23 +546,11 @@ if cohere_api_key and co:
     if st.button("加载样本图像", key="load_sample_button"):
         sample_img_paths, sample_doc_embeddings = download_and_embed_sample_images(_cohere_client=co)
         if sample_img_paths and sample_doc_embeddings is not None:
-            # 将样本图像添加到会话状态（避免重复）
-            current_paths = set(st.session_state.image_paths)
-            new_paths = [p for p in sample_img_paths if p not in current_paths]
-
-            if new_paths:
-                # 提取新图像对应的嵌入
-                new_embeddings_to_add = sample_doc_embeddings[
-                    [idx for idx, p in enumerate(sample_img_paths) if p in new_paths]]
-
-                # 更新会话状态
-                st.session_state.image_paths.extend(new_paths)
-                if st.session_state.doc_embeddings is None or st.session_state.doc_embeddings.size == 0:
-                    st.session_state.doc_embeddings = new_embeddings_to_add
-                else:
-                    st.session_state.doc_embeddings = np.vstack(
-                        (st.session_state.doc_embeddings, new_embeddings_to_add))
-                st.success(f"已加载{len(new_paths)}张样本图像")
+            # 写入持久化存储（已存在的路径会被跳过），再刷新会话状态
+            added = embedding_store.add(sample_img_paths, sample_doc_embeddings)
+            sync_session_from_store(embedding_store)
+            if added:
+                st.success(f"已加载{added}张样本图像")
             else:
                 st.info("样本图像已加载")
         else:
@@ -442,56 +580,67 @@ if uploaded_files and co:
 
     newly_uploaded_paths = []  # 新上传的图像路径
     newly_uploaded_embeddings = []  # 新上传图像的嵌入
+    newly_uploaded_hashes = []  # 新上传图像的内容哈希
+    seen_hashes = set()  # 本次上传中已处理内容的哈希，跨文件去重
+    skipped = {"existing": 0, "duplicate": 0}  # 去重跳过的图像/页面数
 
     for i, uploaded_file in enumerate(uploaded_files):
-        # 检查是否已处理过该文件（简单的文件名检查）
-        img_path = os.path.join(upload_folder, uploaded_file.name)
-        if img_path not in st.session_state.image_paths:
-            try:
-                # 检查文件类型
-                file_type = uploaded_file.type
-                if file_type == "application/pdf":
-                    # 处理PDF - 返回页面路径列表和嵌入列表
-                    pdf_page_paths, pdf_page_embeddings = process_pdf_file(uploaded_file, cohere_client=co)
-                    if pdf_page_paths and pdf_page_embeddings:
-                        # 只添加不在会话状态中的路径/嵌入
-                        current_paths_set = set(st.session_state.image_paths)
-                        unique_new_paths = [p for p in pdf_page_paths if p not in current_paths_set]
-                        if unique_new_paths:
-                            indices_to_add = [i for i, p in enumerate(pdf_page_paths) if p in unique_new_paths]
-                            newly_uploaded_paths.extend(unique_new_paths)
-                            newly_uploaded_embeddings.extend([pdf_page_embeddings[idx] for idx in indices_to_add])
-                elif file_type in ["image/png", "image/jpeg"]:
-                    # 处理常规图像
+        try:
+            # 检查文件类型
+            file_type = uploaded_file.type
+            if file_type == "application/pdf":
+                # 处理PDF - 只返回内容哈希此前未出现过的页面
+                pdf_page_paths, pdf_page_embeddings, pdf_page_hashes, pdf_skipped = process_pdf_file(
+                    uploaded_file, cohere_client=co, store=embedding_store,
+                    batch_size=int(embed_batch_size), concurrency=int(embed_concurrency), seen_hashes=seen_hashes)
+                for key, count in pdf_skipped.items():
+                    skipped[key] += count
+                if pdf_page_paths and pdf_page_embeddings:
+                    newly_uploaded_paths.extend(pdf_page_paths)
+                    newly_uploaded_embeddings.extend(pdf_page_embeddings)
+                    newly_uploaded_hashes.extend(pdf_page_hashes)
+            elif file_type in ["image/png", "image/jpeg"]:
+                # 处理常规图像：先按内容哈希去重，已加载过或内容重复的图像不再写盘和嵌入
+                content_hash = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+                # 按内容哈希分目录保存：同名但内容不同的图像不会覆盖已入库的文件
+                img_path = os.path.join(upload_folder, content_hash[:16], uploaded_file.name)
+                if embedding_store.lookup(img_path, content_hash) is not None:
+                    skipped["existing"] += 1
+                elif content_hash in seen_hashes or embedding_store.has_hash(content_hash):
+                    skipped["duplicate"] += 1
+                else:
+                    seen_hashes.add(content_hash)
                     # 保存上传的文件
+                    os.makedirs(os.path.dirname(img_path), exist_ok=True)
                     with open(img_path, "wb") as f:
                         f.write(uploaded_file.getbuffer())
 
-                    # 获取嵌入
                     base64_img = base64_from_image(img_path)
                     emb = compute_image_embedding(base64_img, _cohere_client=co)
 
                     if emb is not None:
                         newly_uploaded_paths.append(img_path)
                         newly_uploaded_embeddings.append(emb)
-                else:
-                    st.warning(f"跳过不支持的文件类型: {uploaded_file.name}（{file_type}）")
+                        newly_uploaded_hashes.append(content_hash)
+            else:
+                st.warning(f"跳过不支持的文件类型: {uploaded_file.name}（{file_type}）")
 
-            except Exception as e:
-                st.error(f"处理{uploaded_file.name}时出错: {e}")
+        except Exception as e:
+            st.error(f"处理{uploaded_file.name}时出错: {e}")
         # 更新进度条（无论处理状态如何，提供用户反馈）
         progress_bar.progress((i + 1) / len(uploaded_files))
 
-    # 将新处理的文件添加到会话状态
+    if skipped["existing"] or skipped["duplicate"]:
+        st.info(f"去重：跳过{skipped['existing']}个已加载的图像/页面，"
+                f"{skipped['duplicate']}个与其他图像/页面内容相同的图像/页面（均未重复嵌入）")
+
+    # 将新处理的文件追加到持久化存储并刷新会话状态
     if newly_uploaded_paths:
-        st.session_state.image_paths.extend(newly_uploaded_paths)
         if newly_uploaded_embeddings:
-            new_embeddings_array = np.vstack(newly_uploaded_embeddings)
-            if st.session_state.doc_embeddings is None or st.session_state.doc_embeddings.size == 0:
-                st.session_state.doc_embeddings = new_embeddings_array
-            else:
-                st.session_state.doc_embeddings = np.vstack((st.session_state.doc_embeddings, new_embeddings_array))
-            st.success(f"成功处理并添加了{len(newly_uploaded_paths)}张新图像")
+            added = embedding_store.add(newly_uploaded_paths, np.vstack(newly_uploaded_embeddings),
+                                        hashes=newly_uploaded_hashes)
+            sync_session_from_store(embedding_store)
+            st.success(f"成功处理并添加了{added}张新图像")
         else:
             st.warning("无法为新上传的图像生成嵌入")
     elif uploaded_files:  # 选择了文件但没有新文件
@@ -546,7 +695,10 @@ if run_button:
             if len(st.session_state.image_paths) != st.session_state.doc_embeddings.shape[0]:
                 st.error("错误：图像数量与嵌入数量不匹配，无法继续")
             else:
-                top_image_path = search(question, co, st.session_state.doc_embeddings, st.session_state.image_paths)
+                hits = search_top_k(question, co, st.session_state.doc_embeddings, st.session_state.image_paths,
+                                    top_k=int(search_top_k_count), index=vector_index,
+                                    query_cache=get_query_cache())
+                top_image_path = hits[0][0] if hits else None
 
                 if top_image_path:
                     # 生成图像标题
@@ -555,11 +707,16 @@ if run_button:
                     if top_image_path.startswith("pdf_pages/"):
                         parts = top_image_path.split(os.sep)
                         if len(parts) >= 3:
-                            pdf_name = parts[1]
+                            pdf_name = parts[1]  # pdf_pages/<PDF名>/<内容哈希>/page_N.png
                             page_name = parts[-1]
                             caption = f"为问题检索到的内容: '{question}'（来源: {pdf_name}.pdf, {page_name.replace('.png', '')}）"
 
                     retrieved_image_placeholder.image(top_image_path, caption=caption, use_container_width=True)
+                    if len(hits) > 1:
+                        with st.expander(f"其他候选内容（top-{len(hits)}）", expanded=False):
+                            cols = st.columns(len(hits) - 1)
+                            for col, (path, score) in zip(cols, hits[1:]):
+                                col.image(path, caption=f"{os.path.basename(path)}（相似度 {score:.3f}）")
 
                     with st.spinner("正在生成回答..."):
                         final_answer = answer(question, top_image_path, genai_client)
@@ -571,6 +728,12 @@ if run_button:
         # 此情况理论上会被按钮的disabled状态阻止
         st.error("无法运行RAG。请检查API客户端并确保图像已加载且生成了嵌入")
 
+# 查询嵌入缓存统计（放在脚本末尾，包含本次运行的命中情况）
+query_cache_stats = get_query_cache().stats()
+st.sidebar.caption(f"🧠 查询嵌入缓存: 内存命中{query_cache_stats['memory_hits']}，磁盘命中{query_cache_stats['disk_hits']}，"
+                   f"未命中{query_cache_stats['misses']}（命中率{query_cache_stats['hit_rate']:.0%}，"
+                   f"共{query_cache_stats['entries']}条）")
+
 # 页脚
 st.markdown("---")
 st.caption("基于Cohere Embed-4的视觉RAG | 使用Streamlit、Cohere Embed-4和Google Gemini 2.5 Flash构建")
\ No newline at end of file